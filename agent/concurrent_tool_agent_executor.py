@@ -0,0 +1,124 @@
+"""
+This Python file provides the AgentExecutor used by the key info retrieval agent.
+When the agent asks for several tool calls in one step, they run concurrently through the async tool,
+under a cap on the number of tool calls in flight and a timeout for each call.
+Every tool call is recorded in a trace, which shows how much the tool calls of an agent run overlap.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from langchain.agents import AgentExecutor
+from langchain.pydantic_v1 import Field
+from langchain_core.agents import AgentAction, AgentStep
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun
+from langchain_core.tools import BaseTool
+
+from globalParameter.parameters import AGENT_TOOL_CONCURRENCY, AGENT_TOOL_TIMEOUT, AGENT_TOOL_TRACE
+from util.loop_semaphore import LoopSemaphore
+
+
+class ToolCallTrace:
+    """
+    Use this ToolCallTrace to:
+        1. record the start and end of each tool call of each agent run
+        2. report the tool calls of an agent run on a time line, with the maximum number of calls at once
+    """
+
+    def __init__(self, max_spans: int = 10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def record(self, run_id, tool: str, tool_input, start: float, end: float, status: str):
+        self.spans.append({'run_id': run_id, 'tool': tool, 'tool_input': str(tool_input),
+                           'start': start, 'end': end, 'status': status})
+
+    @staticmethod
+    def max_overlap(spans: list[dict]) -> int:
+        # Sweep the starts and ends in time order, ends first when they meet
+        events = sorted([(span['start'], 1) for span in spans] + [(span['end'], -1) for span in spans],
+                        key=lambda event: (event[0], event[1]))
+        running, max_running = 0, 0
+        for _, change in events:
+            running += change
+            max_running = max(max_running, running)
+        return max_running
+
+    def report(self, run_id=None, width: int = 50) -> str:
+        """
+        To Get the time line of the tool calls of an agent run
+        :param run_id: the run of agent, None for all recorded calls
+        :param width: the number of characters of the time line
+        :return: multi line report
+        """
+        spans = [span for span in self.spans if run_id is None or span['run_id'] == run_id]
+        if not spans:
+            return "no tool calls"
+        origin = min(span['start'] for span in spans)
+        wall = max(span['end'] for span in spans) - origin
+        busy = sum(span['end'] - span['start'] for span in spans)
+        lines = [f"{len(spans)} tool calls, at most {self.max_overlap(spans)} at once, "
+                 f"{busy:.2f} s of calls in {wall:.2f} s"]
+        for span in sorted(spans, key=lambda span: span['start']):
+            begin = int((span['start'] - origin) / wall * width) if wall > 0 else 0
+            end = max(begin + 1, int((span['end'] - origin) / wall * width) if wall > 0 else width)
+            lines.append(f"|{' ' * begin}{'#' * (end - begin)}{' ' * (width - end)}| "
+                         f"{span['end'] - span['start']:6.2f} s {span['status']:<7} {span['tool_input'][:60]}")
+        return "\n".join(lines)
+
+
+class ConcurrentToolAgentExecutor(AgentExecutor):
+    """
+    An AgentExecutor which runs the tool calls of one step concurrently, with a cap and a timeout
+    """
+    # The number of tool calls in flight at once across all runs of this executor
+    max_tool_concurrency: int = AGENT_TOOL_CONCURRENCY
+    # The seconds one tool call can take before the agent is told it timed out, None for no timeout
+    tool_timeout: Optional[float] = AGENT_TOOL_TIMEOUT
+    # Print the tool call trace of each agent run
+    print_tool_call_trace: bool = AGENT_TOOL_TRACE
+    tool_call_trace: ToolCallTrace = Field(default_factory=ToolCallTrace)
+    # The cap of tool calls in flight, one semaphore per event loop, created on first use
+    tool_call_semaphore: Optional[LoopSemaphore] = None
+
+    def _get_tool_call_semaphore(self) -> LoopSemaphore:
+        if self.tool_call_semaphore is None:
+            self.tool_call_semaphore = LoopSemaphore(self.max_tool_concurrency)
+        return self.tool_call_semaphore
+
+    async def _aperform_agent_action(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        async with self._get_tool_call_semaphore():
+            start = time.perf_counter()
+            status = "done"
+            try:
+                return await asyncio.wait_for(
+                    super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager),
+                    timeout=self.tool_timeout)
+            except asyncio.TimeoutError:
+                # Tell the agent, so it can answer with the other tool calls instead of failing the whole run
+                status = "timeout"
+                return AgentStep(action=agent_action,
+                                 observation=f"The tool call timed out after {self.tool_timeout} seconds.")
+            except BaseException:
+                status = "error"
+                raise
+            finally:
+                self.tool_call_trace.record(run_id=run_manager.run_id if run_manager else None,
+                                            tool=agent_action.tool,
+                                            tool_input=agent_action.tool_input,
+                                            start=start,
+                                            end=time.perf_counter(),
+                                            status=status)
+
+    async def _acall(self, inputs: Dict[str, str],
+                     run_manager: Optional[AsyncCallbackManagerForChainRun] = None) -> Dict[str, str]:
+        output = await super()._acall(inputs, run_manager=run_manager)
+        if self.print_tool_call_trace and run_manager:
+            print(self.tool_call_trace.report(run_id=run_manager.run_id))
+        return output
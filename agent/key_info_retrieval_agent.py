@@ -1,23 +1,49 @@
-from langchain import hub
+import threading
+
 from langchain.agents import create_openai_tools_agent, AgentExecutor
-from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
+from agent.concurrent_tool_agent_executor import ConcurrentToolAgentExecutor
 from globalParameter.parameters import MODEL
+from prompt.prompt_of_key_info_retrieval_agent import KEY_INFO_RETRIEVAL_AGENT_SYSTEM, KEY_INFO_RETRIEVAL_AGENT_PROMPT
 from tools.retrieval_qa_with_llm_and_resort_tool import RetrievalQAWithLLMAndResortTool
+from util.openai_clients import create_rate_limited_chat_openai
+
+# Agents are stateless between calls, so one agent per temperature is shared by all files
+_key_info_retrieval_agents = {}
+_agents_lock = threading.Lock()
+
+
+def get_key_info_retrieval_agent_prompt() -> ChatPromptTemplate:
+    # The same messages as the hub prompt "hwchase17/openai-tools-agent"
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", KEY_INFO_RETRIEVAL_AGENT_SYSTEM),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("human", KEY_INFO_RETRIEVAL_AGENT_PROMPT),
+            MessagesPlaceholder(variable_name="agent_scratchpad"),
+        ]
+    )
+
 
+def get_key_info_retrieval_agent(temperature: float = 0.5) -> AgentExecutor:
+    with _agents_lock:
+        agent_executor = _key_info_retrieval_agents.get(float(temperature))
+        if agent_executor is not None:
+            return agent_executor
 
-def get_key_info_retrieval_agent(temperature: float = 0.5):
-    # Get the prompt to use - you can modify this!
-    prompt = hub.pull("hwchase17/openai-tools-agent")
+        # Get the prompt to use - you can modify this!
+        prompt = get_key_info_retrieval_agent_prompt()
 
-    # Choose the LLM that will drive the agent
-    # Only certain models support this
-    llm = ChatOpenAI(model='gpt-4o', temperature=temperature)
-    tools = [RetrievalQAWithLLMAndResortTool()]
-    # Construct the OpenAI Tools agent
-    agent = create_openai_tools_agent(llm, tools, prompt)
+        # Choose the LLM that will drive the agent
+        # Only certain models support this, its calls reserve quota in the global rate limiter
+        llm = create_rate_limited_chat_openai(model='gpt-4o', temperature=temperature)
+        tools = [RetrievalQAWithLLMAndResortTool()]
+        # Construct the OpenAI Tools agent
+        agent = create_openai_tools_agent(llm, tools, prompt)
 
-    # Create an agent executor by passing in the agent and tools
-    agent_executor = AgentExecutor(agent=agent, tools=tools)
+        # Create an agent executor by passing in the agent and tools, tool calls of one step run concurrently
+        agent_executor = ConcurrentToolAgentExecutor(agent=agent, tools=tools)
 
-    return agent_executor
+        _key_info_retrieval_agents[float(temperature)] = agent_executor
+        return agent_executor
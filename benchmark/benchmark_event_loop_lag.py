@@ -0,0 +1,30 @@
+"""
+This benchmark checks that a call of RetrievalQAWithLLMAndResortTool does not block the event loop.
+It runs the tool on a real knowledge base under LoopLagProbe and prints the loop lag next to the call time;
+a max lag far below the call time means other files could keep generating while the tool waits.
+Note:
+    It calls the OpenAI API and needs a built knowledge base, e.g. one from generation_version_4.py.
+    Run it from the project root:
+    python -m benchmark.benchmark_event_loop_lag "version4/child/<file name>" "What is the project start date?"
+"""
+import asyncio
+import sys
+import time
+
+from tools.retrieval_qa_with_llm_and_resort_tool import RetrievalQAWithLLMAndResortTool
+from util.loop_lag_probe import LoopLagProbe
+
+
+async def main(knowledge_base: str, question: str):
+    tool = RetrievalQAWithLLMAndResortTool()
+    async with LoopLagProbe() as probe:
+        start = time.perf_counter()
+        answer = await tool.acall(question=question, knowledge_base=knowledge_base)
+        seconds = time.perf_counter() - start
+
+    print(answer)
+    print(f"tool call took {seconds:.2f} s, {probe.report()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(knowledge_base=sys.argv[1], question=sys.argv[2]))
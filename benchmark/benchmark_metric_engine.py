@@ -0,0 +1,73 @@
+"""
+This micro-benchmark compares the CPU time per section of the lexical metrics calculated by the metric engine,
+which tokenizes each text once and runs ROUGE once, against the previous calls of one function per metric,
+which tokenized both texts for BLEU and METEOR each and ran ROUGE for ROUGE-1 and ROUGE-L each.
+Note:
+    Run it from the project root: python -m benchmark.benchmark_metric_engine
+    The NLTK data (punkt, wordnet) is downloaded on first use if it is missing
+"""
+import random
+import time
+
+from nltk.tokenize import word_tokenize
+from nltk.translate import meteor_score
+from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from rouge import Rouge
+
+from util.evaluation_matrix import calculate_metrics, ensure_nltk_resources
+
+SECTION_NUM = 36
+VOCABULARY = ("project emission reduction baseline scenario carbon forest energy methane monitoring plan "
+              "stakeholder community biomass renewable grid electricity leakage additionality verification "
+              "crediting period location proponent tonnes CO2e annual estimated sectoral scope methodology").split()
+
+
+def previous_metrics(generation_text: str, target_text: str) -> dict:
+    """The previous implementation: each metric tokenizes the texts again, and ROUGE runs once per ROUGE metric"""
+    def bleu():
+        smoothie = SmoothingFunction().method4
+        return float(sentence_bleu([word_tokenize(target_text)], word_tokenize(generation_text),
+                                   smoothing_function=smoothie))
+
+    def meteor():
+        return float(meteor_score.meteor_score([word_tokenize(target_text)], word_tokenize(generation_text)))
+
+    def rouge():
+        return Rouge(metrics=['rouge-l', 'rouge-1']).get_scores(generation_text, target_text, avg=True)
+
+    return {
+        'BLEU': bleu(),
+        'METEOR': meteor(),
+        'ROUGE_1': rouge()['rouge-1']['f'],
+        'ROUGE_L': rouge()['rouge-l']['f']
+    }
+
+
+def build_text(word_num: int) -> str:
+    """To build a synthetic section of word_num words in sentences of 20 words"""
+    words = random.choices(VOCABULARY, k=word_num)
+    return " ".join(" ".join(words[i:i + 20]).capitalize() + "." for i in range(0, word_num, 20))
+
+
+def main():
+    random.seed(0)
+    ensure_nltk_resources()
+    print(f"{'words':<8} {'previous (ms)':>14} {'engine (ms)':>12} {'saved (ms)':>11} {'speed up':>9}")
+    for word_num in [100, 300, 1000]:
+        sections = [(build_text(word_num=word_num), build_text(word_num=word_num)) for _ in range(SECTION_NUM)]
+
+        start = time.process_time()
+        previous_scores = [previous_metrics(generation_text, target_text) for generation_text, target_text in sections]
+        previous_seconds = (time.process_time() - start) / SECTION_NUM
+
+        start = time.process_time()
+        engine_scores = [calculate_metrics(generation_text, target_text) for generation_text, target_text in sections]
+        engine_seconds = (time.process_time() - start) / SECTION_NUM
+
+        assert previous_scores == engine_scores, "The metric engine must give the same scores"
+        print(f"{word_num:<8} {previous_seconds * 1000:>14.2f} {engine_seconds * 1000:>12.2f} "
+              f"{(previous_seconds - engine_seconds) * 1000:>11.2f} {previous_seconds / engine_seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
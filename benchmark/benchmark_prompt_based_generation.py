@@ -0,0 +1,96 @@
+"""
+This benchmark compares calls per second of a new ChatOpenAI per call (the old behaviour)
+against the shared, pooled chat models of util/prompt_based_generation.
+All calls go to a local mock of the OpenAI chat completions endpoint, so no API key or quota is needed.
+Note:
+    Run it from the project root: python -m benchmark.benchmark_prompt_based_generation
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_openai import ChatOpenAI
+
+from util.prompt_based_generation import prompt_based_generation, aprompt_based_generation
+
+CALL_NUM = 200
+ASYNC_BATCH = 20
+
+MOCK_RESPONSE = json.dumps({
+    "id": "chatcmpl-mock",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-3.5-turbo",
+    "choices": [{"index": 0,
+                 "message": {"role": "assistant", "content": "{\"answer\": \"mock\"}"},
+                 "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+}).encode('utf-8')
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Answer every chat completion request with the same response over keep-alive HTTP/1.1"""
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one segment, otherwise Nagle and delayed ACK dominate the timings
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    connection_count = 0
+
+    def setup(self):
+        super().setup()
+        MockOpenAIHandler.connection_count += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(MOCK_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(MOCK_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def report(name: str, start: float):
+    seconds = time.perf_counter() - start
+    print(f"{name:<35} {CALL_NUM / seconds:>8.1f} calls/s   "
+          f"{MockOpenAIHandler.connection_count:>4} TCP connections")
+    MockOpenAIHandler.connection_count = 0
+
+
+async def main():
+    # Start the mock endpoint and point every OpenAI client at it
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    prompt = "benchmark prompt"
+
+    start = time.perf_counter()
+    for _ in range(CALL_NUM):
+        ChatOpenAI(temperature=0.5).invoke(prompt)
+    report("sync, new ChatOpenAI per call", start)
+
+    start = time.perf_counter()
+    for _ in range(CALL_NUM):
+        prompt_based_generation(prompt=prompt, temperature=0.5, use_cache=False)
+    report("sync, pooled client", start)
+
+    start = time.perf_counter()
+    for _ in range(CALL_NUM // ASYNC_BATCH):
+        await asyncio.gather(*[ChatOpenAI(temperature=0.5).ainvoke(prompt) for _ in range(ASYNC_BATCH)])
+    report("async, new ChatOpenAI per call", start)
+
+    start = time.perf_counter()
+    for _ in range(CALL_NUM // ASYNC_BATCH):
+        await asyncio.gather(*[aprompt_based_generation(prompt=prompt, temperature=0.5, use_cache=False) for _ in range(ASYNC_BATCH)])
+    report("async, pooled client", start)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+This micro-benchmark compares the one-pass Reciprocal Rank Fusion of RetrievalQAWithLLMAndResortTool
+against the previous per-document rescan of every result list, on synthetic multi-query results.
+Note:
+    Run it from the project root: python -m benchmark.benchmark_reciprocal_rank_fusion
+"""
+import random
+import timeit
+
+from langchain_core.documents import Document
+
+from tools.retrieval_qa_with_llm_and_resort_tool import RetrievalQAWithLLMAndResortTool
+
+REPEAT = 20
+
+
+def rescan_parents_importance(common_documents: list[Document], documents_list: list[list[Document]]) -> dict:
+    """The previous implementation: rescan every sub list for each common document, O(docs x lists x k)"""
+    importance_dict = {}
+    for doc in common_documents:
+        parent_key = (doc.metadata['source'], doc.metadata.get('parent_index'))
+        importance_dict.setdefault(parent_key, 0)
+        for sublist in documents_list:
+            for rank, sub_doc in enumerate(sublist):
+                if sub_doc.metadata['index'] == doc.metadata['index']:
+                    importance_dict[parent_key] += 1 / (1 + rank)
+                    break
+    return importance_dict
+
+
+def build_documents_list(list_num: int, k_num: int, parent_num: int, children_per_parent: int) -> list[list[Document]]:
+    """To build list_num result lists of k_num child documents drawn from the same pool"""
+    pool = [Document(page_content=f"parent {i} child {j}",
+                     metadata={'source': 'synthetic', 'parent_index': i, 'index': j})
+            for i in range(parent_num) for j in range(children_per_parent)]
+    return [random.sample(pool, k_num) for _ in range(list_num)]
+
+
+def main():
+    random.seed(0)
+    tool = RetrievalQAWithLLMAndResortTool()
+    print(f"{'lists x k':<12} {'common docs':>11} {'rescan (ms)':>12} {'one pass (ms)':>14} {'speed up':>9}")
+    for list_num, k_num in [(5, 20), (5, 100), (20, 100), (50, 200)]:
+        documents_list = build_documents_list(list_num=list_num, k_num=k_num, parent_num=100, children_per_parent=5)
+        # Use every retrieved document as a common document to show the worst case
+        common_documents = tool.get_common_documents(documents_list=[sum(documents_list, [])])
+
+        rescan_seconds = timeit.timeit(lambda: rescan_parents_importance(common_documents, documents_list),
+                                       number=REPEAT) / REPEAT
+        one_pass_seconds = timeit.timeit(lambda: tool.calculate_parents_importance(common_documents, documents_list),
+                                         number=REPEAT) / REPEAT
+        print(f"{f'{list_num} x {k_num}':<12} {len(common_documents):>11} {rescan_seconds * 1000:>12.2f} "
+              f"{one_pass_seconds * 1000:>14.2f} {rescan_seconds / one_pass_seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,119 +9,179 @@ import asyncio
 import json
 import os.path
 
-from globalParameter.parameters import DOMAIN
-from util.evaluation_matrix import calculate_BLEU, calculate_METEOR, calculate_METEOR_of_summary, calculate_ROUGE, \
-    calculate_Embedding_similarity_of_consine, calculate_GPT_SELF_EVALUATION
+from globalParameter.parameters import DOMAIN, EVALUATION_BLEURT
+from util.evaluation_matrix import acalculate_metrics, calculate_METEOR_of_summary, \
+    acalculate_Embedding_similarities_of_cosine, acalculate_BLEURT, calculate_GPT_SELF_EVALUATION
+from util.pipeline_runner import run_pipeline
 
 
 async def evaluate_generated_file(file_name_without_extension: str, generation_version: str):
     print(f">>>>>>>>>>>>>>> {file_name_without_extension} <<<<<<<<<<<<<<< Evaluation")
-    # Set the File Path for generation, target and template file
-    template_file_path = 'project_template/template_version_1.json'
+    # Set the File Path for generation file
     generated_file_path = f'generated_file/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.json'
+
+    # Load the Template requirement and Target file
+    template_requirements, target_sections = load_evaluation_references(
+        file_name_without_extension=file_name_without_extension)
+    # Load the generation file
+    with open(generated_file_path, 'r', encoding='utf-8') as f:
+        generated_sections = json.load(f)
+
+    # Calculate the embedding similarity of all sections of the file in one batch
+    section_text_pairs = get_section_text_pairs(generated_sections=generated_sections, target_sections=target_sections)
+    try:
+        embedding_similarities = dict(zip(section_text_pairs, await acalculate_Embedding_similarities_of_cosine(
+            text_pairs=list(section_text_pairs.values()))))
+    except Exception as e:
+        # Each section tries again on its own
+        print(f'ERROR----------{file_name_without_extension}----------embedding similarity----------{e}')
+        embedding_similarities = {}
+
+    # Calculate the BLEURT score of all sections of the file in batches, if BLEURT is used
+    bleurt_scores = {}
+    if EVALUATION_BLEURT:
+        try:
+            bleurt_scores = dict(zip(section_text_pairs, await acalculate_BLEURT(
+                text_pairs=list(section_text_pairs.values()))))
+        except Exception as e:
+            # Each section tries again on its own
+            print(f'ERROR----------{file_name_without_extension}----------BLEURT----------{e}')
+
+    # Start iteration and get all evaluation score to store
+    section_evaluations = {}
+    for section_id, section_data in generated_sections.items():
+        section_evaluations[section_id] = await evaluate_section(file_name_without_extension=file_name_without_extension,
+                                                                 section_id=section_id,
+                                                                 section_data=section_data,
+                                                                 template_requirements=template_requirements,
+                                                                 target_sections=target_sections,
+                                                                 embedding_similarity=embedding_similarities.get(section_id),
+                                                                 bleurt_score=bleurt_scores.get(section_id))
+
+    # Combine all section scores and save them
+    save_evaluation_matrix(file_name_without_extension=file_name_without_extension,
+                           generation_version=generation_version,
+                           evaluation_matrix=combine_section_evaluations(section_evaluations=section_evaluations))
+
+
+def load_evaluation_references(file_name_without_extension: str) -> tuple[dict, dict]:
+    """
+    To Load the template requirements and the target file which generated sections are evaluated against
+    :param file_name_without_extension: the file you are evaluating
+    :return: template requirements, target sections
+    """
+    # Set the File Path for target and template file
+    template_file_path = 'project_template/template_version_1.json'
     target_file_path = f'file/{DOMAIN}_extract/structure_1/{file_name_without_extension}.json'
 
     # Load the Template requirement
     with open(template_file_path, 'r', encoding='utf-8') as f:
         template_requirements = json.load(f)
-    # Load the generation file
-    with open(generated_file_path, 'r', encoding='utf-8') as f:
-        generated_sections = json.load(f)
     # Load the Target file
     with open(target_file_path, 'r', encoding='utf-8') as f:
         target_sections = json.load(f)
+    return template_requirements, target_sections
 
-    # Initialise the variables for storing evaluation scores
-    evaluation_matrix = {}
-
-    bleu_result = {}
-    meteor_result = {}
-    meteor_of_summary_result = {}
-    rouge_1_result = {}
-    rouge_l_result = {}
-    embedding_similarity_of_cosine_result = {}
-    gpt_self_evaluation_result = {}
-
-    bleu_total = 0
-    meteor_total = 0
-    meteor_of_summary_total = 0
-    rouge_1_total = 0
-    rouge_l_total = 0
-    embedding_similarity_of_cosine_total = 0
-    gpt_self_evaluation_total = 0
 
-    # Start iteration and get all evaluation score to store
+def get_section_text_pairs(generated_sections: dict, target_sections: dict) -> dict:
+    """
+    To Get the generation text and target text of every section which can be evaluated
+    :param generated_sections: the generated file, keyed by section id
+    :param target_sections: the target file extraction
+    :return: (generation text, target text) keyed by section id, sections whose structure doesn't fit are left out
+    """
+    section_text_pairs = {}
     for section_id, section_data in generated_sections.items():
         # Check the section name
         if (section_id in target_sections.keys()) and (
                 section_data["section_name"].lower() == target_sections[section_id]["section_name"].lower()):
-            # Get the generation and target text of current section
-            generated_data = section_data["generation"]
-            target_data = target_sections[section_id]["section_info"]
-            # Get the template requirement of current section
-            template_requirement = template_requirements[section_id.split('.')[0]]['sections'][section_id][
-                'description']
-
-            # Call functions to calculate evaluation scores
-            while 1:
-                try:
-                    bleu_score = calculate_BLEU(generation_text=generated_data, target_text=target_data)
-                    meteor_score = calculate_METEOR(generation_text=generated_data, target_text=target_data)
-                    meteor_of_summary_score = await calculate_METEOR_of_summary(generation_text=generated_data,
-                                                                                target_text=target_data)
-                    rouge_1_score = calculate_ROUGE(generation_text=generated_data, target_text=target_data)['rouge-1']['f']
-                    rouge_l_score = calculate_ROUGE(generation_text=generated_data, target_text=target_data)['rouge-l']['f']
-                    embedding_similarity_of_cosine_score = calculate_Embedding_similarity_of_consine(
-                        generation_text=generated_data,
-                        target_text=target_data)
-                    gpt_self_evaluation_score = await calculate_GPT_SELF_EVALUATION(template_requirement=template_requirement,
-                                                                                    generation_text=generated_data,
-                                                                                    target_text=target_data)
-                    # Store these evaluation scores
-                    bleu_result[section_id] = bleu_score
-                    meteor_result[section_id] = meteor_score
-                    meteor_of_summary_result[section_id] = meteor_of_summary_score
-                    rouge_1_result[section_id] = rouge_1_score
-                    rouge_l_result[section_id] = rouge_l_score
-                    embedding_similarity_of_cosine_result[section_id] = embedding_similarity_of_cosine_score
-                    gpt_self_evaluation_result[section_id] = gpt_self_evaluation_score
-
-                    # calculate the sum of each score for calculating final score of whole file
-                    bleu_total += bleu_score
-                    meteor_total += meteor_score
-                    meteor_of_summary_total += meteor_of_summary_score
-                    rouge_1_total += rouge_1_score
-                    rouge_l_total += rouge_l_score
-                    embedding_similarity_of_cosine_total += embedding_similarity_of_cosine_score
-                    gpt_self_evaluation_total += gpt_self_evaluation_score['score']
-                    break
-                except Exception as e:
-                    print(f'ERROR----------{file_name_without_extension}----------{section_id}----------{e}')
-                    break
-
-        else:
-            # Skip the section if section structure doesn't fit
-            print(f"The Evaluation of {file_name_without_extension} --- {section_id} is: None")
+            section_text_pairs[section_id] = (section_data["generation"], target_sections[section_id]["section_info"])
+    return section_text_pairs
+
+
+async def evaluate_section(file_name_without_extension: str, section_id: str, section_data: dict,
+                           template_requirements: dict, target_sections: dict, embedding_similarity: float = None,
+                           bleurt_score: float = None):
+    """
+    To calculate all evaluation scores of a generated section
+    :param file_name_without_extension: the file you are evaluating
+    :param section_id: the id of section
+    :param section_data: the generated section, {'section_name': ..., 'generation': ...}
+    :param template_requirements: the template structure
+    :param target_sections: the target file extraction
+    :param embedding_similarity: the embedding similarity of section calculated in a batch, None to calculate it here
+    :param bleurt_score: the BLEURT score of section calculated in a batch, None to calculate it here if BLEURT is used
+    :return: evaluation scores keyed by evaluation matrix, or None if the section can not be evaluated
+    """
+    # Get the generation and target text of current section
+    section_text_pairs = get_section_text_pairs(generated_sections={section_id: section_data},
+                                                target_sections=target_sections)
+    if section_id not in section_text_pairs:
+        # Skip the section if section structure doesn't fit
+        print(f"The Evaluation of {file_name_without_extension} --- {section_id} is: None")
+        return None
+    generated_data, target_data = section_text_pairs[section_id]
+    # Get the template requirement of current section
+    template_requirement = template_requirements[section_id.split('.')[0]]['sections'][section_id]['description']
+
+    # Call functions to calculate evaluation scores, the registered metrics (BLEU, METEOR, ROUGE ...) share one tokenization
+    # and run in the metric process pool, while the metrics calling the model run on the event loop at the same time
+    try:
+        async def get_embedding_similarity() -> float:
+            if embedding_similarity is not None:
+                return embedding_similarity
+            return (await acalculate_Embedding_similarities_of_cosine(text_pairs=[(generated_data, target_data)]))[0]
+
+        async def get_bleurt_score() -> dict:
+            if not EVALUATION_BLEURT:
+                return {}
+            if bleurt_score is not None:
+                return {'BLEURT': bleurt_score}
+            return {'BLEURT': (await acalculate_BLEURT(text_pairs=[(generated_data, target_data)]))[0]}
+
+        (lexical_scores, meteor_of_summary, embedding_similarity_of_cosine, bleurt_scores,
+         gpt_self_evaluation) = await asyncio.gather(
+            acalculate_metrics(generation_text=generated_data, target_text=target_data),
+            calculate_METEOR_of_summary(generation_text=generated_data, target_text=target_data,
+                                        file_name_without_extension=file_name_without_extension, section_id=section_id),
+            get_embedding_similarity(),
+            get_bleurt_score(),
+            calculate_GPT_SELF_EVALUATION(template_requirement=template_requirement,
+                                          generation_text=generated_data,
+                                          target_text=target_data))
+        return {
+            **lexical_scores,
+            'METEOR_OF_SUMMARY': meteor_of_summary,
+            'EMBEDDING_SIMILARITY_OF_COSINE': embedding_similarity_of_cosine,
+            **bleurt_scores,
+            'GPT_SELF_EVALUATION': gpt_self_evaluation
+        }
+    except Exception as e:
+        print(f'ERROR----------{file_name_without_extension}----------{section_id}----------{e}')
+        return None
+
+
+def combine_section_evaluations(section_evaluations: dict) -> dict:
+    """
+    To combine the scores of all sections into the evaluation matrix of whole file
+    :param section_evaluations: evaluation scores of each section keyed by section id, None for skipped sections
+    :return: scores of each section and the final score of whole file, keyed by evaluation matrix
+    """
+    evaluation_matrix = {}
+    for section_id, section_evaluation in section_evaluations.items():
+        if section_evaluation is None:
+            continue
+        for matrix_name, score in section_evaluation.items():
+            evaluation_matrix.setdefault(matrix_name, {})[section_id] = score
 
     # calculate the final score for the whole file for each evaluation matrix
-    bleu_result['final'] = bleu_total / len(list(bleu_result.keys()))
-    meteor_result['final'] = meteor_total / len(list(meteor_result.keys()))
-    meteor_of_summary_result['final'] = meteor_of_summary_total / len(list(meteor_of_summary_result.keys()))
-    rouge_1_result['final'] = rouge_1_total / len(list(rouge_1_result.keys()))
-    rouge_l_result['final'] = rouge_l_total / len(list(rouge_l_result.keys()))
-    embedding_similarity_of_cosine_result['final'] = embedding_similarity_of_cosine_total / len(
-        list(embedding_similarity_of_cosine_result.keys()))
-    gpt_self_evaluation_result['final'] = gpt_self_evaluation_total / len(list(gpt_self_evaluation_result.keys()))
-
-    # Combine all evaluation matrixs together
-    evaluation_matrix['BLEU'] = bleu_result
-    evaluation_matrix['METEOR'] = meteor_result
-    evaluation_matrix['METEOR_OF_SUMMARY'] = meteor_of_summary_result
-    evaluation_matrix['ROUGE_1'] = rouge_1_result
-    evaluation_matrix['ROUGE_L'] = rouge_l_result
-    evaluation_matrix['EMBEDDING_SIMILARITY_OF_COSINE'] = embedding_similarity_of_cosine_result
-    evaluation_matrix['GPT_SELF_EVALUATION'] = gpt_self_evaluation_result
+    for matrix_name, matrix_result in evaluation_matrix.items():
+        scores = [score['score'] if isinstance(score, dict) else score for score in matrix_result.values()]
+        matrix_result['final'] = sum(scores) / len(scores)
+    return evaluation_matrix
+
 
+def save_evaluation_matrix(file_name_without_extension: str, generation_version: str, evaluation_matrix: dict):
     # Save scores
     with open(f"evaluation_result/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.json", 'w',
               encoding='utf-8') as f:
@@ -140,26 +200,40 @@ async def main():
     # Set the generated version you want to evvaluate
     generation_versions = ['1', '2', '4', '5', '6', '3_1', '3_2', '3_4', '3_5', '3_6']
 
+    # Collect the files of all versions which have not been evaluated
+    jobs = []
     for generation_version in generation_versions:
         os.makedirs(f"evaluation_result/{DOMAIN}/version_{generation_version}", exist_ok=True)
-        print(
-            f"============================================================ {generation_version} ============================================================")
-        tasks = []
         already_done_files = os.listdir(f"evaluation_result/{DOMAIN}/version_{generation_version}")
-        # Start iteration and evaluate each generation of specific version
-        for idx, test_dataset in enumerate(test_datasets):
+        for test_dataset in test_datasets:
             file_name_without_extension = test_dataset['file_name']
             if file_name_without_extension + '.json' not in already_done_files:
-                tasks.append(evaluate_generated_file(file_name_without_extension=file_name_without_extension,
-                                                     generation_version=generation_version))
-
-            if len(tasks) == 25:
-                await asyncio.gather(*tasks)
-                tasks = []
-
-        # Process any remaining files
-        if tasks:
-            await asyncio.gather(*tasks)
+                jobs.append((file_name_without_extension, generation_version))
+
+    # Embed the texts of all files in large batches first, so the target texts shared by all versions are embedded once
+    # and the embedding similarity of each file is read from the embedding cache
+    try:
+        text_pairs = []
+        for file_name_without_extension, generation_version in jobs:
+            generated_file_path = f'generated_file/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.json'
+            if not os.path.isfile(generated_file_path):
+                continue
+            template_requirements, target_sections = load_evaluation_references(
+                file_name_without_extension=file_name_without_extension)
+            with open(generated_file_path, 'r', encoding='utf-8') as f:
+                generated_sections = json.load(f)
+            text_pairs.extend(get_section_text_pairs(generated_sections=generated_sections,
+                                                     target_sections=target_sections).values())
+        await acalculate_Embedding_similarities_of_cosine(text_pairs=text_pairs)
+    except Exception as e:
+        # Each file embeds its own texts again
+        print(f'ERROR----------embedding of all files----------{e}')
+
+    # Evaluate all files with a pool of 25 workers, each pulling the next file when it is free
+    await run_pipeline(name="evaluation",
+                       jobs=jobs,
+                       run_job=evaluate_generated_file,
+                       worker_num=25)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+This script runs a draft version, the version 3 refinement built on it and the evaluation of both as one DAG of section tasks.
+A section is refined as soon as its draft is written, and a section of any version is evaluated as soon as it exists,
+so the stages overlap across sections and files instead of each stage waiting for the whole test set of the stage before.
+Note:
+    You need to manually adjust the base version in main() program, version 4 and 5 are supported.
+"""
+import asyncio
+import json
+import os
+
+from evaluation import load_evaluation_references, evaluate_section, combine_section_evaluations, \
+    save_evaluation_matrix
+from generation_version_3 import refine_section_version_3, build_the_train_knowledge_bases
+from generation_version_4 import get_section_generator_version_4
+from generation_version_5 import get_section_generator_version_5
+from globalParameter.parameters import DOMAIN
+from tools.retrieval_refine_with_target_text_tool import RetrievalRefineWithTargetTextTool
+from util.dag_executor import DagExecutor
+from util.section_scheduler import get_template_section_ids
+from util.section_store import SectionStore
+from util.tool_result_cache import tool_result_cache
+
+SECTION_GENERATORS = {
+    '4': get_section_generator_version_4,
+    '5': get_section_generator_version_5
+}
+
+
+def add_file_tasks(dag: DagExecutor, file_name_without_extension: str, base_version: str, doc_template: dict,
+                   retrieval_refine_with_target_text_tool: RetrievalRefineWithTargetTextTool) -> list[SectionStore]:
+    """
+    To add the tasks of drafting, refining and evaluating every section of a file into the DAG
+    :param dag: the DAG of all files
+    :param file_name_without_extension: the file you are generating
+    :param base_version: the version of draft, which version 3 refines
+    :param doc_template: the template structure
+    :param retrieval_refine_with_target_text_tool: the refine tool shared by all files
+    :return: the section stores of draft and refined versions, to be closed when the DAG is done
+    """
+    refined_version = f'3_{base_version}'
+    section_ids = get_template_section_ids(doc_template=doc_template)
+    section_stores = {
+        base_version: SectionStore(generation_version=base_version, file_name_without_extension=file_name_without_extension),
+        refined_version: SectionStore(generation_version=refined_version, file_name_without_extension=file_name_without_extension)
+    }
+
+    async def prepare():
+        generate_section = None
+        # A file whose drafts are all generated needs neither its knowledge base nor its key fact sheet
+        if not section_stores[base_version].done_section_ids().issuperset(section_ids):
+            # Build the knowledge base and tools of the file without blocking other files
+            generate_section, key_fact_sheet = await asyncio.to_thread(
+                SECTION_GENERATORS[base_version], file_name_without_extension=file_name_without_extension)
+            # Answer the key fact sheet once, before any section of the file starts
+            await key_fact_sheet.abuild()
+        template_requirements, target_sections = load_evaluation_references(
+            file_name_without_extension=file_name_without_extension)
+        return generate_section, template_requirements, target_sections
+
+    async def draft(prepared, chapter_id, section_id, section_template):
+        section_generation = section_stores[base_version].get(section_id=section_id)
+        if section_generation is None:
+            generate_section, template_requirements, target_sections = prepared
+            section_generation = await generate_section(chapter_id, section_id, section_template)
+            section_stores[base_version].put(section_id=section_id, section_generation=section_generation)
+        return section_generation
+
+    async def refine(prepared, draft_section, section_id):
+        section_generation = section_stores[refined_version].get(section_id=section_id)
+        if section_generation is None:
+            generate_section, template_requirements, target_sections = prepared
+            section_generation = await refine_section_version_3(
+                section_id=section_id,
+                draft_section=draft_section,
+                target_file=target_sections,
+                retrieval_refine_with_target_text_tool=retrieval_refine_with_target_text_tool)
+            section_stores[refined_version].put(section_id=section_id, section_generation=section_generation)
+        return section_generation
+
+    async def evaluate(prepared, section_data, section_id):
+        generate_section, template_requirements, target_sections = prepared
+        return await evaluate_section(file_name_without_extension=file_name_without_extension,
+                                      section_id=section_id,
+                                      section_data=section_data,
+                                      template_requirements=template_requirements,
+                                      target_sections=target_sections)
+
+    async def compact(version, *section_generations):
+        section_stores[version].compact(section_ids=section_ids)
+        if version == base_version:
+            # The tool results of this file are not needed by other files
+            tool_result_cache.clear(knowledge_base=f"version{base_version}/child/{file_name_without_extension}")
+
+    async def save_evaluation(version, *section_evaluations):
+        save_evaluation_matrix(file_name_without_extension=file_name_without_extension,
+                               generation_version=version,
+                               evaluation_matrix=combine_section_evaluations(
+                                   section_evaluations=dict(zip(section_ids, section_evaluations))))
+
+    prepare_id = ('prepare', file_name_without_extension)
+    dag.add_task(task_id=prepare_id, run=prepare)
+
+    for chapter_id, chapter_template in doc_template.items():
+        for section_id, section_template in chapter_template['sections'].items():
+            dag.add_task(task_id=('draft', file_name_without_extension, section_id),
+                         run=lambda prepared, c=chapter_id, s=section_id, t=section_template: draft(prepared, c, s, t),
+                         dependencies=[prepare_id])
+            dag.add_task(task_id=('refine', file_name_without_extension, section_id),
+                         run=lambda prepared, draft_section, s=section_id: refine(prepared, draft_section, s),
+                         dependencies=[prepare_id, ('draft', file_name_without_extension, section_id)])
+
+    for version, stage in [(base_version, 'draft'), (refined_version, 'refine')]:
+        section_task_ids = [(stage, file_name_without_extension, section_id) for section_id in section_ids]
+        dag.add_task(task_id=('compact', file_name_without_extension, version),
+                     run=lambda *section_generations, v=version: compact(v, *section_generations),
+                     dependencies=section_task_ids)
+
+        # Evaluate each section as soon as it exists, unless the file has been evaluated in the past
+        if os.path.isfile(f"evaluation_result/{DOMAIN}/version_{version}/{file_name_without_extension}.json"):
+            continue
+        evaluate_task_ids = []
+        for section_id, section_task_id in zip(section_ids, section_task_ids):
+            evaluate_task_id = ('evaluate', file_name_without_extension, version, section_id)
+            dag.add_task(task_id=evaluate_task_id,
+                         run=lambda prepared, section_data, s=section_id: evaluate(prepared, section_data, s),
+                         dependencies=[prepare_id, section_task_id])
+            evaluate_task_ids.append(evaluate_task_id)
+        dag.add_task(task_id=('save_evaluation', file_name_without_extension, version),
+                     run=lambda *section_evaluations, v=version: save_evaluation(v, *section_evaluations),
+                     dependencies=evaluate_task_ids)
+
+    return list(section_stores.values())
+
+
+async def main():
+    base_version = '5'
+    for version in [base_version, f'3_{base_version}']:
+        os.makedirs(f"evaluation_result/{DOMAIN}/version_{version}", exist_ok=True)
+
+    # Load the train and test files with summary
+    train_test_file_path = f"project_template/template_version_1_{DOMAIN}_summary.json"
+    with open(train_test_file_path, 'r', encoding='utf-8') as f:
+        train_test_datasets = json.load(f)
+
+    # Check if the knowledge base of version3 exists and construct it.
+    if not os.path.isdir("vectorDB/chromaDB/version3"):
+        build_the_train_knowledge_bases(train_files=train_test_datasets['train'])
+
+    # Load the Template structure
+    template_file_path = "project_template/template_version_1.json"
+    with open(template_file_path, 'r', encoding='utf-8') as f:
+        doc_template = json.load(f)
+
+    # Add the tasks of all test files into one DAG
+    dag = DagExecutor(name=f"version {base_version} -> version 3_{base_version} -> evaluation")
+    retrieval_refine_with_target_text_tool = RetrievalRefineWithTargetTextTool()
+    section_stores = []
+    for test_dataset in train_test_datasets['test']:
+        section_stores.extend(add_file_tasks(dag=dag,
+                                             file_name_without_extension=test_dataset['file_name'],
+                                             base_version=base_version,
+                                             doc_template=doc_template,
+                                             retrieval_refine_with_target_text_tool=retrieval_refine_with_target_text_tool))
+
+    try:
+        await dag.run()
+    finally:
+        for section_store in section_stores:
+            section_store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
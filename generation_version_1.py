@@ -1,6 +1,7 @@
 """
 This is version 1 of the system, which generates overall documents by using the analyzed template requirements and a simple summary of the files.
 """
+import asyncio
 import json
 import os
 
@@ -9,11 +10,18 @@ from langchain_core.messages import SystemMessage
 
 from globalParameter.parameters import DOMAIN
 from prompt.prompt_of_generation_with_template_only import GENERATION_WITH_TEMPLATE_ONLY_SYSTEM, GENERATION_WITH_TEMPLATE_ONLY_PROMPT
-from util.prompt_based_generation import prompt_based_generation
+from util.pipeline_runner import run_pipeline
+from util.prompt_based_generation import aprompt_based_generation
+from util.retry_policy import RetryPolicy
+from util.section_scheduler import get_template_section_ids
+from util.section_store import SectionStore
+
+# Retry policy of the calls generating a section
+generation_retry_policy = RetryPolicy(name="version 1 generation")
 
-if __name__ == "__main__":
-    os.makedirs(f"generated_file/{DOMAIN}/version_1", exist_ok=True)
 
+async def generation_version_1(file_name_without_extension: str, file_summary: str):
+    print(f">>>>>>>>>>>>>>> {file_name_without_extension} <<<<<<<<<<<<<<< version 1")
     # Set up the Message Template for generation
     chat_template = ChatPromptTemplate.from_messages(
         [
@@ -22,52 +30,67 @@ if __name__ == "__main__":
         ]
     )
 
-    # Load the train and test files with summary
-    train_test_file_path = f"project_template/template_version_1_{DOMAIN}_summary.json"
-    with open(train_test_file_path, 'r', encoding='utf-8') as f:
-        train_test_datasets = json.load(f)
-
     # Load the Template structure
     template_file_path = "project_template/template_version_1.json"
     with open(template_file_path, 'r', encoding='utf-8') as f:
         doc_template = json.load(f)
 
-    # Get the test files with summary and generate each one by one
-    test_datasets = train_test_datasets['test']
-    for idx, test_dataset in enumerate(test_datasets):
-        file_name_without_extension = test_dataset['file_name']
-        file_summary = test_dataset['summary']
-        print(f">>>>>>>>>>>>>>>>>>>>>>>>>>>>>> {file_name_without_extension} <<<<<<<<<<<<<<<<<<<<<<<<<<<<<< {idx}/{len(test_datasets)}")
+    # Get generation in the past, each section is committed to the section store as soon as it is done
+    section_store = SectionStore(generation_version='1', file_name_without_extension=file_name_without_extension)
+    try:
+        done_section_ids = section_store.done_section_ids()
 
         # Get the Chapter and section info
-        file_generation = {}
         for chapter_id, chapter_template in doc_template.items():
             chapter_name = chapter_template["name"]
             sections_template = chapter_template["sections"]
             for section_id, section_template in sections_template.items():
+                if section_id in done_section_ids:
+                    continue
                 section_name = section_template["name"]
                 section_description = section_template["description"]
 
                 # Format the whole messages with input variables using message template
-                messages = chat_template.format_messages(section_requirement=section_description, knowledge=file_summary)
+                messages = chat_template.format_messages(section_requirement=section_description,
+                                                         knowledge=file_summary)
 
                 # Call the model for generating
-                while 1:
-                    try:
-                        response = prompt_based_generation(prompt=messages, temperature=0.5)
-                        break
-                    except Exception as e:
-                        print(e)
+                response = await generation_retry_policy.arun(
+                    lambda: aprompt_based_generation(prompt=messages, temperature=0.5),
+                    label=f"{file_name_without_extension} --- {section_id}")
                 generation = response.content
 
                 # Store the generation with section id and name info
-                file_generation[section_id] = {
+                section_store.put(section_id=section_id, section_generation={
                     'section_name': section_name,
                     'generation': generation
-                }
+                })
+
+        # Write the whole file into correct JSON file in template order
+        section_store.compact(section_ids=get_template_section_ids(doc_template=doc_template))
+    finally:
+        section_store.close()
+
 
-        # Write into correct JSON file
-        with open(f"generated_file/{DOMAIN}/version_1/{file_name_without_extension}.json", 'w', encoding='utf-8') as f:
-            json.dump(file_generation, f, indent=4)
+async def main():
+    os.makedirs(f"generated_file/{DOMAIN}/version_1", exist_ok=True)
 
+    # Load the train and test files with summary
+    train_test_file_path = f"project_template/template_version_1_{DOMAIN}_summary.json"
+    with open(train_test_file_path, 'r', encoding='utf-8') as f:
+        train_test_datasets = json.load(f)
 
+    # Get the test files with summary
+    test_datasets = train_test_datasets['test']
+
+    file_summaries = {test_dataset['file_name']: test_dataset['summary'] for test_dataset in test_datasets}
+
+    # Generate the test files with a pool of workers, each pulling the next file when it is free
+    await run_pipeline(name="version 1",
+                       jobs=[(file_name,) for file_name in file_summaries.keys()],
+                       run_job=lambda file_name: generation_version_1(file_name_without_extension=file_name,
+                                                                      file_summary=file_summaries[file_name]))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
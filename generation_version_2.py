@@ -14,7 +14,15 @@ from prompt.prompt_of_generation_with_template_and_key_info import GENERATION_WI
     GENERATION_WITH_TEMPLATE_AND_KEY_INFO_PROMPT
 from tools.retrieval_qa_tool import RetrievalQATool
 from util.chroma_db_util import ChromaDBUtil
+from util.key_info_retrieval import aretrieve_key_infos
+from util.pipeline_runner import run_pipeline
 from util.prompt_based_generation import aprompt_based_generation
+from util.retry_policy import RetryPolicy
+from util.section_scheduler import get_template_section_ids
+from util.section_store import SectionStore
+
+# Retry policy of the calls generating a section
+generation_retry_policy = RetryPolicy(name="version 2 generation")
 
 
 async def generation_version_2(file_name_without_extension: str):
@@ -44,76 +52,58 @@ async def generation_version_2(file_name_without_extension: str):
     chroma_util.initialise_vectorstore_with_files(persist_directory=f"version2/{file_name_without_extension}",
                                                   files=[target_file_path])
 
-    # Generation start
-    file_generation = {}
-    for chapter_id, chapter_template in doc_template.items():
-        chapter_name = chapter_template["name"]
-        sections_template = chapter_template["sections"]
-        for section_id, section_template in sections_template.items():
-            section_name = section_template["name"]
-            section_description = section_template["description"]
-
-            # Get detailed table for section
-            section_key_table = detailed_table[section_id]['detailed_table']
-            key_infos = []
-
-            # Set up the retrieval query and start to retrieve key info
-            for key_name, key_description in section_key_table.items():
-                question = f"find an answer for {key_name}, which has a description: {key_description}"
-                query = f"{key_name} with description: {key_description}"
-
-                # start to retrieve key info
-                while 1:
-                    try:
-                        answer = await retrieval_qa_tool.acall(
-                            question=question,
-                            query=query,
-                            knowledge_base=f"version2/{file_name_without_extension}"
-                        )
-                        break
-                    except Exception as e:
-                        print(e)
-
-                # Check if the model can find correct answer
-                if answer['find_answer_in_extracted_part'].lower() == 'YES'.lower():
-                    key_answer = answer['answer']
-                else:
-                    key_answer = None
-
-                # Store the key info
-                key_infos.append({
-                    'key_name': key_name,
-                    'key_description': key_description,
-                    'key_info/answer': key_answer
+    # Get generation in the past, each section is committed to the section store as soon as it is done
+    section_store = SectionStore(generation_version='2', file_name_without_extension=file_name_without_extension)
+    try:
+        done_section_ids = section_store.done_section_ids()
+
+        # Generation start
+        for chapter_id, chapter_template in doc_template.items():
+            chapter_name = chapter_template["name"]
+            sections_template = chapter_template["sections"]
+            for section_id, section_template in sections_template.items():
+                if section_id in done_section_ids:
+                    continue
+                section_name = section_template["name"]
+                section_description = section_template["description"]
+
+                # Get detailed table for section
+                section_key_table = detailed_table[section_id]['detailed_table']
+
+                # Set up the retrieval query and retrieve key info of all keys concurrently
+                key_infos = await aretrieve_key_infos(
+                    section_key_table=section_key_table,
+                    answer_key=lambda key_name, key_description: retrieval_qa_tool.acall(
+                        question=f"find an answer for {key_name}, which has a description: {key_description}",
+                        query=f"{key_name} with description: {key_description}",
+                        knowledge_base=f"version2/{file_name_without_extension}"
+                    ))
+
+                # Format the key info for section
+                key_data = ""
+                for key_info in key_infos:
+                    key_data += f"Key_name: {key_info['key_name']}\nKey_info: {key_info['key_info/answer']}\n\n"
+
+                # Format the whole messages with input variables using message template
+                messages = chat_template.format_messages(section_requirement=section_description, key_info=key_data)
+
+                # Call the model for generating
+                response = await generation_retry_policy.arun(
+                    lambda: aprompt_based_generation(prompt=messages, temperature=0.5),
+                    label=f"{file_name_without_extension} --- {section_id}")
+
+                generation = response.content
+
+                # Store the generation with section id and name info
+                section_store.put(section_id=section_id, section_generation={
+                    'section_name': section_name,
+                    'generation': generation
                 })
 
-            # Format the key info for section
-            key_data = ""
-            for key_info in key_infos:
-                key_data += f"Key_name: {key_info['key_name']}\nKey_info: {key_info['key_info/answer']}\n\n"
-
-            # Format the whole messages with input variables using message template
-            messages = chat_template.format_messages(section_requirement=section_description, key_info=key_data)
-
-            # Call the model for generating
-            while 1:
-                try:
-                    response = await aprompt_based_generation(prompt=messages, temperature=0.5)
-                    break
-                except Exception as e:
-                    print(e)
-
-            generation = response.content
-
-            # Store the generation with section id and name info
-            file_generation[section_id] = {
-                'section_name': section_name,
-                'generation': generation
-            }
-
-    # Write into correct JSON file
-    with open(f"generated_file/{DOMAIN}/version_2/{file_name_without_extension}.json", 'w', encoding='utf-8') as f:
-        json.dump(file_generation, f, indent=4)
+        # Write the whole file into correct JSON file in template order
+        section_store.compact(section_ids=get_template_section_ids(doc_template=doc_template))
+    finally:
+        section_store.close()
 
 
 async def main():
@@ -127,21 +117,11 @@ async def main():
     # Get the test files with summary
     test_datasets = train_test_datasets['test']
 
-    # Asynchronous call for generating tasks for 1 files each time
-    files_list = []
-    for idx, test_dataset in enumerate(test_datasets):
-        file_name_without_extension = test_dataset['file_name']
-        files_list.append(file_name_without_extension)
-
-        if len(files_list) == 1:
-            tasks = [generation_version_2(file_name) for file_name in files_list]
-            await asyncio.gather(*tasks)
-            files_list = []
-
-    # Process any remaining files
-    if files_list:
-        tasks = [generation_version_2(file_name) for file_name in files_list]
-        await asyncio.gather(*tasks)
+    # Generate the test files one at a time with a single worker
+    await run_pipeline(name="version 2",
+                       jobs=[(test_dataset['file_name'],) for test_dataset in test_datasets],
+                       run_job=generation_version_2,
+                       worker_num=1)
 
 
 if __name__ == "__main__":
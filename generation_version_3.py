@@ -12,6 +12,13 @@ from langchain_core.documents import Document
 from globalParameter.parameters import DOMAIN
 from tools.retrieval_refine_with_target_text_tool import RetrievalRefineWithTargetTextTool
 from util.chroma_db_util import ChromaDBUtil
+from util.pipeline_runner import run_pipeline
+from util.retry_policy import RetryPolicy
+from util.section_scheduler import get_template_section_ids
+from util.section_store import SectionStore
+
+# Retry policy of the calls refining a section
+refine_retry_policy = RetryPolicy(name="version 3 refinement")
 
 
 async def generation_version_3(file_name_without_extension: str, base_version: str):
@@ -39,65 +46,70 @@ async def generation_version_3(file_name_without_extension: str, base_version: s
     # Create the refine tool object for function call
     retrieval_refine_with_target_text_tool = RetrievalRefineWithTargetTextTool()
 
-    # Get generation in the past
-    if os.path.isfile(f"generated_file/{DOMAIN}/version_3_{base_version}/{file_name_without_extension}.json"):
-        with open(f"generated_file/{DOMAIN}/version_3_{base_version}/{file_name_without_extension}.json", 'r', encoding='utf-8') as f:
-            file_generation = json.load(f)
-    else:
-        file_generation = {}
-
-    # Generation start
-    for chapter_id, chapter_template in doc_template.items():
-        chapter_name = chapter_template['name']
-        sections_template = chapter_template['sections']
-        for section_id, section_template in sections_template.items():
-            print(f"{file_name_without_extension} --- {chapter_id} --- {section_id}")
-            if section_id in file_generation.keys():
-                continue
-            # Get draft section name and text for current section
-            draft_section_name = draft_file[section_id]['section_name']
-            draft_section_text = draft_file[section_id]['generation']
-
-            # Jump to next section if original file does not contain current section
-            if section_id not in target_file.keys():
-                file_generation[section_id] = {
-                    'section_name': draft_section_name,
-                    'generation': draft_section_text
-                }
-                continue
-
-            # Get the target section name and sample text for current section
-            target_section_name = target_file[section_id]['section_name']
-            target_section_text = target_file[section_id]['section_info']
-
-            # Check if section name is correct
-            if draft_section_name.lower() == target_section_name.lower():
-                # Call refine tool to optimise the draft section text
-                while 1:
-                    try:
-                        response = await retrieval_refine_with_target_text_tool.acall(
-                            target_text=target_section_text,
-                            draft_text=draft_section_text,
-                            knowledge_base=f'version3/{draft_section_name}')
-                        new_generation = response['optimised_text']
-                        break
-
-                    except Exception as e:
-                        print(e)
-
-                file_generation[section_id] = {
-                    'section_name': draft_section_name,
-                    'generation': new_generation
-                }
-            else:
-                file_generation[section_id] = {
-                    'section_name': draft_section_name,
-                    'generation': draft_section_text
-                }
-
-    # Write into correct JSON file
-    with open(f"generated_file/{DOMAIN}/version_3_{base_version}/{file_name_without_extension}.json", 'w', encoding='utf-8') as f:
-        json.dump(file_generation, f, indent=4)
+    # Get generation in the past, each section is committed to the section store as soon as it is done
+    section_store = SectionStore(generation_version=f'3_{base_version}', file_name_without_extension=file_name_without_extension)
+    try:
+        done_section_ids = section_store.done_section_ids()
+
+        # Generation start
+        for chapter_id, chapter_template in doc_template.items():
+            chapter_name = chapter_template['name']
+            sections_template = chapter_template['sections']
+            for section_id, section_template in sections_template.items():
+                print(f"{file_name_without_extension} --- {chapter_id} --- {section_id}")
+                if section_id in done_section_ids:
+                    continue
+                section_generation = await refine_section_version_3(
+                    section_id=section_id,
+                    draft_section=draft_file[section_id],
+                    target_file=target_file,
+                    retrieval_refine_with_target_text_tool=retrieval_refine_with_target_text_tool)
+                section_store.put(section_id=section_id, section_generation=section_generation)
+
+        # Write the whole file into correct JSON file in template order
+        section_store.compact(section_ids=get_template_section_ids(doc_template=doc_template))
+    finally:
+        section_store.close()
+
+
+async def refine_section_version_3(section_id: str, draft_section: dict, target_file: dict,
+                                   retrieval_refine_with_target_text_tool: RetrievalRefineWithTargetTextTool) -> dict:
+    # Get draft section name and text for current section
+    draft_section_name = draft_section['section_name']
+    draft_section_text = draft_section['generation']
+
+    # Keep the draft if original file does not contain current section
+    if section_id not in target_file.keys():
+        return {
+            'section_name': draft_section_name,
+            'generation': draft_section_text
+        }
+
+    # Get the target section name and sample text for current section
+    target_section_name = target_file[section_id]['section_name']
+    target_section_text = target_file[section_id]['section_info']
+
+    # Keep the draft if section name is not correct
+    if draft_section_name.lower() != target_section_name.lower():
+        return {
+            'section_name': draft_section_name,
+            'generation': draft_section_text
+        }
+
+    # Call refine tool to optimise the draft section text
+    async def refine() -> str:
+        response = await retrieval_refine_with_target_text_tool.acall(
+            target_text=target_section_text,
+            draft_text=draft_section_text,
+            knowledge_base=f'version3/{draft_section_name}')
+        return response['optimised_text']
+
+    new_generation = await refine_retry_policy.arun(refine, label=section_id)
+
+    return {
+        'section_name': draft_section_name,
+        'generation': new_generation
+    }
 
 
 def build_the_train_knowledge_bases(train_files: list[str]):
@@ -152,21 +164,11 @@ async def main():
     # Get the test files with summary
     test_datasets = train_test_datasets['test']
 
-    # Asynchronous call for generating tasks for 5 files each time
-    files_list = []
-    for idx, test_dataset in enumerate(test_datasets):
-        file_name_without_extension = test_dataset['file_name']
-        files_list.append(file_name_without_extension)
-
-        if len(files_list) == 25:
-            tasks = [generation_version_3(file_name_without_extension=file_name, base_version=base_version) for file_name in files_list]
-            await asyncio.gather(*tasks)
-            files_list = []
-
-    # Process any remaining files
-    if files_list:
-        tasks = [generation_version_3(file_name_without_extension=file_name, base_version=base_version) for file_name in files_list]
-        await asyncio.gather(*tasks)
+    # Refine the test files with a pool of 25 workers, each pulling the next file when it is free
+    await run_pipeline(name=f"version 3_{base_version}",
+                       jobs=[(test_dataset['file_name'], base_version) for test_dataset in test_datasets],
+                       run_job=generation_version_3,
+                       worker_num=25)
 
 
 if __name__ == "__main__":
@@ -11,13 +11,63 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from globalParameter.parameters import DOMAIN
 from prompt.prompt_of_generation_with_template_and_key_info import GENERATION_WITH_TEMPLATE_AND_KEY_INFO_SYSTEM, \
     GENERATION_WITH_TEMPLATE_AND_KEY_INFO_PROMPT
-from tools.retrieval_qa_with_llm_and_resort_tool import RetrievalQAWithLLMAndResortTool
+from tools.retrieval_qa_with_llm_and_resort_tool import RetrievalQAWithLLMAndResortTool, report_compression
 from util.chroma_db_util import ChromaDBUtil
+from util.key_fact_sheet import KeyFactSheet
+from util.pipeline_runner import run_pipeline
 from util.prompt_based_generation import aprompt_based_generation
+from util.retry_policy import RetryPolicy
+from util.section_scheduler import generate_sections_concurrently, get_template_section_ids
+from util.section_store import SectionStore
+from util.tool_result_cache import tool_result_cache
+
+# Retry policy of the calls generating a section
+generation_retry_policy = RetryPolicy(name="version 4 generation")
 
 
 async def generation_version_4(file_name_without_extension: str):
     print(f">>>>>>>>>>>>>>> {file_name_without_extension} <<<<<<<<<<<<<<< version 4")
+    # Load the Template structure
+    template_file_path = "project_template/template_version_1.json"
+    with open(template_file_path, 'r', encoding='utf-8') as f:
+        doc_template = json.load(f)
+
+    # Get generation in the past, each section is committed to the section store as soon as it is done
+    section_store = SectionStore(generation_version='4', file_name_without_extension=file_name_without_extension)
+
+    try:
+        section_ids = get_template_section_ids(doc_template=doc_template)
+        done_section_ids = section_store.done_section_ids()
+        # A file whose sections are all generated needs neither its knowledge base nor its key fact sheet
+        if not done_section_ids.issuperset(section_ids):
+            # Get the section generator of this file, and answer its key fact sheet before any section starts
+            generate_section, key_fact_sheet = get_section_generator_version_4(
+                file_name_without_extension=file_name_without_extension)
+            await key_fact_sheet.abuild()
+
+            # Generation start, all sections which have not been generated run concurrently
+            await generate_sections_concurrently(
+                doc_template=doc_template,
+                done_section_ids=done_section_ids,
+                generate_section=generate_section,
+                on_section_done=section_store.put)
+
+        # Write the whole file into correct JSON file in template order
+        section_store.compact(section_ids=section_ids)
+    finally:
+        section_store.close()
+        # The tool results of this file are not needed by other files
+        tool_result_cache.clear(knowledge_base=f"version4/child/{file_name_without_extension}")
+        print(f"{file_name_without_extension} tool results: {tool_result_cache.report()}, {report_compression()}")
+
+
+def get_section_generator_version_4(file_name_without_extension: str):
+    """
+    To prepare everything the sections of a file need and Get the generator of its sections
+    :param file_name_without_extension: the file you are generating
+    :return: async function(chapter_id, section_id, section_template) returning the section generation,
+             and the key fact sheet of the file, which must be built before the sections start
+    """
     # Set up the Message Template for generation
     chat_template = ChatPromptTemplate.from_messages(
         [
@@ -26,11 +76,6 @@ async def generation_version_4(file_name_without_extension: str):
         ]
     )
 
-    # Load the Template structure
-    template_file_path = "project_template/template_version_1.json"
-    with open(template_file_path, 'r', encoding='utf-8') as f:
-        doc_template = json.load(f)
-
     # Load the detailed table for core info retrieval
     detailed_table_file_path = "project_template/template_version_1_detailed_table.json"
     with open(detailed_table_file_path, 'r', encoding='utf-8') as f:
@@ -40,83 +85,58 @@ async def generation_version_4(file_name_without_extension: str):
     retrieval_qa_with_llm_and_resort_tool = RetrievalQAWithLLMAndResortTool()
     build_version_4_knowledge_base(file_name_without_extension=file_name_without_extension)
 
-    # Get generation in the past
-    if os.path.isfile(f"generated_file/{DOMAIN}/version_4/{file_name_without_extension}.json"):
-        with open(f"generated_file/{DOMAIN}/version_4/{file_name_without_extension}.json", 'r', encoding='utf-8') as f:
-            file_generation = json.load(f)
-    else:
-        file_generation = {}
-
-    # Generation start
-    for chapter_id, chapter_template in doc_template.items():
-        chapter_name = chapter_template["name"]
-        sections_template = chapter_template["sections"]
-        for section_id, section_template in sections_template.items():
-            print(f"{file_name_without_extension} --- {chapter_id} --- {section_id}")
-            if section_id in file_generation.keys():
-                continue
-            section_name = section_template["name"]
-            section_description = section_template["description"]
-
-            # Get detailed table for section
-            section_key_table = detailed_table[section_id]['detailed_table']
-            key_infos = []
-
-            # Set up the retrieval question and start to retrieve key info
-            for key_name, key_description in section_key_table.items():
-                question = f"find an answer for {key_name}, which has a description: {key_description}"
-
-                # start to retrieve key info
-                while 1:
-                    try:
-                        answer = await retrieval_qa_with_llm_and_resort_tool.acall(
-                            question=question,
-                            knowledge_base=f"version4/child/{file_name_without_extension}"
-                        )
-                        break
-                    except Exception as e:
-                        print(e)
-
-                # Check if the model can find correct answer
-                if answer['find_answer_in_extracted_part'].lower() == 'YES'.lower():
-                    key_answer = answer['answer']
-                else:
-                    key_answer = None
-
-                # Store the key info
-                key_infos.append({
-                    'key_name': key_name,
-                    'key_description': key_description,
-                    'key_info/answer': key_answer
-                })
-
-            # Format the key info for section
-            key_data = ""
-            for key_info in key_infos:
-                key_data += f"Key_name: {key_info['key_name']}\nKey_info: {key_info['key_info/answer']}\n\n"
-
-            # Format the whole messages with input varibales using template
-            messages = chat_template.format_messages(section_requirement=section_description, key_info=key_data)
-
-            # Call the model for generating
-            while 1:
-                try:
-                    response = await aprompt_based_generation(prompt=messages, temperature=0.5)
-                    break
-                except Exception as e:
-                    print(e)
-
-            generation = response.content
-
-            # Store the generation with section id and name info
-            file_generation[section_id] = {
-                'section_name': section_name,
-                'generation': generation
-            }
+    # Set up the key fact sheet, each unique key of the detailed tables is answered once for all sections
+    key_fact_sheet = KeyFactSheet(
+        generation_version='4',
+        file_name_without_extension=file_name_without_extension,
+        detailed_table=detailed_table,
+        answer_key=lambda key_name, key_description: retrieval_qa_with_llm_and_resort_tool.acall(
+            question=f"find an answer for {key_name}, which has a description: {key_description}",
+            knowledge_base=f"version4/child/{file_name_without_extension}"
+        ))
+
+    def generate_section(chapter_id: str, section_id: str, section_template: dict):
+        return generate_section_version_4(
+            file_name_without_extension=file_name_without_extension,
+            chapter_id=chapter_id,
+            section_id=section_id,
+            section_template=section_template,
+            chat_template=chat_template,
+            key_fact_sheet=key_fact_sheet)
+
+    return generate_section, key_fact_sheet
+
+
+async def generate_section_version_4(file_name_without_extension: str, chapter_id: str, section_id: str,
+                                     section_template: dict, chat_template: ChatPromptTemplate,
+                                     key_fact_sheet: KeyFactSheet) -> dict:
+    print(f"{file_name_without_extension} --- {chapter_id} --- {section_id}")
+    section_name = section_template["name"]
+    section_description = section_template["description"]
+
+    # Get key info of all keys of the section from the key fact sheet of the file
+    key_infos = key_fact_sheet.get_section_key_infos(section_id=section_id)
+
+    # Format the key info for section
+    key_data = ""
+    for key_info in key_infos:
+        key_data += f"Key_name: {key_info['key_name']}\nKey_info: {key_info['key_info/answer']}\n\n"
+
+    # Format the whole messages with input varibales using template
+    messages = chat_template.format_messages(section_requirement=section_description, key_info=key_data)
+
+    # Call the model for generating
+    response = await generation_retry_policy.arun(
+        lambda: aprompt_based_generation(prompt=messages, temperature=0.5),
+        label=f"{file_name_without_extension} --- {section_id}")
+
+    generation = response.content
 
-            # Write into correct JSON file every section
-            with open(f"generated_file/{DOMAIN}/version_4/{file_name_without_extension}.json", 'w', encoding='utf-8') as f:
-                json.dump(file_generation, f, indent=4)
+    # Return the generation with section name info
+    return {
+        'section_name': section_name,
+        'generation': generation
+    }
 
 
 def build_version_4_knowledge_base(file_name_without_extension: str):
@@ -187,21 +207,10 @@ async def main():
     # Get the test files with summary
     test_datasets = train_test_datasets['test']
 
-    # Asynchronous call for generating tasks for 1 files each time
-    files_list = []
-    for idx, test_dataset in enumerate(test_datasets):
-        file_name_without_extension = test_dataset['file_name']
-        files_list.append(file_name_without_extension)
-
-        if len(files_list) == 5:
-            tasks = [generation_version_4(file_name) for file_name in files_list]
-            await asyncio.gather(*tasks)
-            files_list = []
-
-    # Process any remaining files
-    if files_list:
-        tasks = [generation_version_4(file_name) for file_name in files_list]
-        await asyncio.gather(*tasks)
+    # Generate the test files with a pool of workers, each pulling the next file when it is free
+    await run_pipeline(name="version 4",
+                       jobs=[(test_dataset['file_name'],) for test_dataset in test_datasets],
+                       run_job=generation_version_4)
 
 
 if __name__ == "__main__":
@@ -14,3 +14,87 @@ MODEL = "gpt-3.5-turbo"
 
 # Set up your domain
 DOMAIN = "Energy_demand"
+
+# Set up the shared HTTP connection pool used by every LLM call, and the seconds one request (or its connect) can take
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 30
+HTTP_TIMEOUT = 600
+HTTP_CONNECT_TIMEOUT = 10
+
+# Set up the global rate limit shared by all OpenAI traffic, fill in the quota of your account
+REQUESTS_PER_MINUTE = 5000
+TOKENS_PER_MINUTE = 800000
+MAX_CONCURRENT_REQUESTS = 50
+RATE_LIMIT_RETRY_NUM = 5
+# Retries of connection errors, timeouts and 5xx responses, with jittered exponential backoff from 1 second
+TRANSIENT_ERROR_RETRY_NUM = 3
+# The number of output tokens assumed for a request when reserving quota
+COMPLETION_TOKENS_ESTIMATE = 500
+
+# Set up the on-disk cache of LLM completions
+# 'deterministic' only caches calls with temperature 0, 'all' also caches calls with temperature > 0,
+# which then replay their first sampled answer on every run instead of sampling again, 'off' disables the cache
+# Entries not used for COMPLETION_CACHE_MAX_AGE_DAYS days are removed
+COMPLETION_CACHE_MODE = "deterministic"
+COMPLETION_CACHE_PATH = "cache/completion_cache.sqlite"
+COMPLETION_CACHE_MAX_MB = 1024
+COMPLETION_CACHE_MAX_AGE_DAYS = 30
+
+# Set up the on-disk cache of embeddings, vectors are stored as float32
+EMBEDDING_CACHE_PATH = "cache/embedding_cache.sqlite"
+
+# Set up the on-disk store of section summaries used by the METEOR of summary, kept without eviction
+SUMMARY_STORE_PATH = "cache/summary_store.sqlite"
+
+# Set up the number of Chroma vectorstores kept open for reuse
+VECTORSTORE_CACHE_SIZE = 64
+
+# Set up the number of sections generated at the same time, shared by all files
+SECTION_CONCURRENCY = 20
+
+# Set up the retrieval of key infos: seconds before one key is retried, and retries before it is given up
+KEY_INFO_TIMEOUT = 300
+KEY_INFO_RETRY_NUM = 3
+
+# Set up the store of generated sections: committed sections between two syncs to disk
+SECTION_STORE_SYNC_EVERY = 5
+
+# Set up the runner of generation and evaluation jobs: workers, seconds one try of a job can take,
+# retries before a job is given up and seconds between two progress reports
+PIPELINE_WORKER_NUM = 5
+PIPELINE_JOB_TIMEOUT = 3600
+PIPELINE_RETRY_NUM = 1
+PIPELINE_REPORT_INTERVAL = 60
+
+# Set up the number of tasks running at the same time in the DAG of generation, refinement and evaluation
+DAG_MAX_CONCURRENCY = 20
+
+# Set up the retry policy of generation, refinement and evaluation calls:
+# attempts before a call is given up, and seconds of backoff after the first failed attempt (doubled each time, capped)
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+
+# Set up the reuse of tool results inside a document: cosine similarity above which a near-duplicate question
+# reuses a stored answer (e.g. 0.95), None to reuse the answers of identical questions only
+TOOL_RESULT_CACHE_SIMILARITY = None
+
+# Set up the tool calls of the key info retrieval agent: calls in flight at once, seconds one call can take,
+# and whether the time line of the tool calls of each agent run is printed
+AGENT_TOOL_CONCURRENCY = 5
+AGENT_TOOL_TIMEOUT = 300
+AGENT_TOOL_TRACE = False
+
+# Set up the number of processes calculating the CPU bound metrics (BLEU, METEOR, ROUGE), None for one per core
+METRIC_PROCESS_NUM = None
+
+# Set up the number of texts in one embeddings call of the embedding similarity of evaluation
+EVALUATION_EMBEDDING_BATCH_SIZE = 100
+
+# Set up the resources of the evaluation metrics: download missing NLTK data on first use or fail,
+# and the BLEURT metric (off by default), its model and the number of sections in one forward pass
+NLTK_AUTO_DOWNLOAD = True
+EVALUATION_BLEURT = False
+BLEURT_MODEL = "Elron/bleurt-base-512"
+BLEURT_BATCH_SIZE = 8
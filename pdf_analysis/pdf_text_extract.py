@@ -100,53 +100,29 @@ async def main():
             section_messages.append(messages)
             sections_ids_in_messages.append(section_id)
 
-            # start to call openai api in async way, every 5 sections
-            if len(section_messages) == 5:
-                logging.warning(sections_ids_in_messages)
-                tasks = []
-                for messages_id, messages in enumerate(section_messages):
-                    # Create tasks for async run
-                    tasks.append(aget_openai_response(section_id=sections_ids_in_messages[messages_id],
-                                                      section_name=file_content[sections_ids_in_messages[messages_id]][
-                                                          'section_name'],
-                                                      messages=messages, temperature=0.5, json_format=True, retry_num=1))
-                # Get responses
-                responses = await asyncio.gather(*tasks)
-                # Check the format of response and add them into logging if error happens
-                for response in responses:
-                    # If the model doesn't output response with correct Json format
-                    if len(list(response.keys())) > 1:
-                        logging.error(
-                            f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- response length over 1: {response.keys()}")
-                    # If the model output doesn't contain section info
-                    for key, value in response.items():
-                        file_data[key] = value
-                        if value['section_info'] is None:
-                            logging.error(
-                                f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- FAIL to process: {value['section_id']} {value['section_name']}")
-                section_messages = []
-                sections_ids_in_messages = []
-
-        # check if there are sections left, we need to run async call for one more time
-        if len(section_messages) > 0:
-            logging.warning(sections_ids_in_messages)
-            tasks = []
-            for messages_id, messages in enumerate(section_messages):
-                tasks.append(aget_openai_response(section_id=sections_ids_in_messages[messages_id],
-                                                  section_name=file_content[sections_ids_in_messages[messages_id]][
-                                                      'section_name'],
-                                                  messages=messages, temperature=0.5, json_format=True, retry_num=1))
-            responses = await asyncio.gather(*tasks)
-            for response in responses:
-                if len(list(response.keys())) > 1:
+        # Call openai api for all sections in async way, the global rate limiter decides how many run at once
+        logging.warning(sections_ids_in_messages)
+        tasks = []
+        for messages_id, messages in enumerate(section_messages):
+            # Create tasks for async run
+            tasks.append(aget_openai_response(section_id=sections_ids_in_messages[messages_id],
+                                              section_name=file_content[sections_ids_in_messages[messages_id]][
+                                                  'section_name'],
+                                              messages=messages, temperature=0.5, json_format=True, retry_num=1))
+        # Get responses
+        responses = await asyncio.gather(*tasks)
+        # Check the format of response and add them into logging if error happens
+        for response in responses:
+            # If the model doesn't output response with correct Json format
+            if len(list(response.keys())) > 1:
+                logging.error(
+                    f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- response length over 1: {response.keys()}")
+            # If the model output doesn't contain section info
+            for key, value in response.items():
+                file_data[key] = value
+                if value['section_info'] is None:
                     logging.error(
-                        f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- response length over 1: {response.keys()}")
-
-                for key, value in response.items():
-                    file_data[key] = value
-                    if value['section_info'] is None:
-                        logging.error(
-                            f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- FAIL to process: {value['section_id']} {value['section_name']}")
+                        f"---------- PLEASE CHECK THE DATA OF THIS FILE ---------- FAIL to process: {value['section_id']} {value['section_name']}")
 
         # check the content of file data
         for key, value in file_data.items():
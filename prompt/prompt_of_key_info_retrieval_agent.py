@@ -0,0 +1,4 @@
+# Vendored from the LangChain Hub prompt "hwchase17/openai-tools-agent", so building the agent needs no network
+KEY_INFO_RETRIEVAL_AGENT_SYSTEM = "You are a helpful assistant"
+
+KEY_INFO_RETRIEVAL_AGENT_PROMPT = "{input}"
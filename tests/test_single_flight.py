@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from util.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_computation():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(*[single_flight.run("key", compute) for _ in range(5)])
+        return results, single_flight.is_pending("key")
+
+    results, pending = asyncio.run(main())
+    assert results == [42] * 5
+    assert len(calls) == 1
+    assert not pending
+
+
+def test_error_is_shared_with_every_caller():
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("no answer")
+
+    async def main():
+        single_flight = SingleFlight()
+        return await asyncio.gather(*[single_flight.run("key", compute) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelled_owner_does_not_cancel_waiters():
+    async def compute():
+        await asyncio.sleep(0.3)
+        return "summary"
+
+    async def main():
+        single_flight = SingleFlight()
+        owner = asyncio.create_task(asyncio.wait_for(single_flight.run("key", compute), timeout=0.1))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(single_flight.run("key", compute))
+        with pytest.raises(asyncio.TimeoutError):
+            await owner
+        return await waiter
+
+    assert asyncio.run(main()) == "summary"
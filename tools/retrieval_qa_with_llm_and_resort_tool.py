@@ -2,7 +2,7 @@
 This tool can help you answer relevant questions by retrieving from an external knowledge base.
 """
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, Counter
 from typing import Type, Any, Union
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import BaseTool
@@ -16,7 +16,18 @@ from prompt.prompt_of_multi_query import MULTI_QUERY_SYSTEM, MULTI_QUERY_PROMPT
 from prompt.prompt_of_retrieval_qa_tool import RETRIEVAL_QA_TOOL_PROMPT, RETRIEVAL_QA_TOOL_SYSTEM
 from tools.retrieval_tool import RetrievalTool
 from util.chroma_db_util import ChromaDBUtil
+from util.completion_cache import refresh_completions
 from util.prompt_based_generation import prompt_based_generation, aprompt_based_generation
+from util.rate_limiter import estimate_tokens
+from util.tool_result_cache import tool_result_cache
+
+# How many contextual compression calls were made and saved by the early cut-off, shared by all tools of this process
+compression_counters = Counter()
+
+
+def report_compression() -> str:
+    return (f"{compression_counters['made']} compression calls made, {compression_counters['saved']} saved "
+            f"({compression_counters['below_importance']} below importance threshold)")
 
 
 class RetrievalQAWithLLMAndResortInput(BaseModel):
@@ -34,6 +45,15 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
     name = "RetrievalQAWithLLMAndResortTool"
     description = "useful for when you need to answer a question based on extra information retrieved from a specified knowledge base"
     args_schema: Type[BaseModel] = RetrievalQAWithLLMAndResortInput
+    # The constant k of Reciprocal Rank Fusion, RRF formula = 1 / (k + rank) with rank starting from 1,
+    # 0 gives the scores of the original resort, 60 is the usual constant of the RRF paper
+    rrf_k: float = 0
+    # Contextual compression in Async way: compressions run at once, and it stops after max documents
+    # or token budget of useful compressions, parent documents below min importance are skipped
+    compression_max_concurrency: int = 5
+    compression_max_documents: int = 8
+    compression_token_budget: int = 3000
+    compression_min_importance: float = 0.0
 
     @staticmethod
     def get_common_documents(documents_list: Union[list[list[Document]], Any]) -> list[Document]:
@@ -60,44 +80,45 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
         return common_objects
 
     @staticmethod
-    def reciprocal_rank_fusion_calculation(doc: Document, documents_list: list[list[Document]]) -> float:
-        # Initialise the rrf score
-        rrf_score = 0.0
+    def get_document_key(document: Document) -> tuple:
+        # A child document is identified by its source, its parent and its index inside the parent
+        return document.metadata['source'], document.metadata.get('parent_index'), document.metadata['index']
 
-        # Start iteration and get score of each sub list
-        for sublist in documents_list:
-            # rrf of sub list calculation
-            for rank, sub_doc in enumerate(sublist):
-                # Check if we find the correct document in sub list
-                if sub_doc.metadata['index'] == doc.metadata['index']:
-                    # Calculate rrf of sub lis, RRF formula = 1 / (k + rank), here k = 1
-                    rrf_score += 1 / (1 + rank)
-                    break
+    def reciprocal_rank_fusion_calculation(self, documents_list: Union[list[list[Document]], Any]) -> dict:
+        # Initialise the rrf score of each document
+        rrf_scores = defaultdict(float)
 
-        return rrf_score
+        # Start iteration and add the score of each sub list in one pass
+        for sublist in documents_list:
+            seen_keys = set()
+            for rank, sub_doc in enumerate(sublist, start=1):
+                key = self.get_document_key(sub_doc)
+                # Only the best rank of a document in a sub list counts
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+                # RRF formula = 1 / (k + rank), the first document has rank 1
+                rrf_scores[key] += 1 / (self.rrf_k + rank)
+
+        return rrf_scores
 
     def calculate_parents_importance(self, common_documents: list[Document],
                                      documents_list: Union[list[list[Document]], Any]) -> dict:
+        # Get the rrf score of every retrieved document
+        rrf_scores = self.reciprocal_rank_fusion_calculation(documents_list=documents_list)
+
         # Initialise the dict to store the importance of parent document
-        importance_dict = {}
+        importance_dict = defaultdict(float)
 
-        # Start iteration and calculate importance of parent document
+        # Start iteration and add the importance of each common document to its parent document
         for doc in common_documents:
-            parent_index = doc.metadata.get('parent_index')
-            parent_key = (doc.metadata['source'], parent_index)
-
-            # Initialise the importance of parent document
-            if parent_key not in importance_dict:
-                importance_dict[parent_key] = 0
+            parent_key = (doc.metadata['source'], doc.metadata.get('parent_index'))
+            importance_dict[parent_key] += rrf_scores[self.get_document_key(doc)]
 
-            # Calculate the importance and add it to specific parent document
-            importance = self.reciprocal_rank_fusion_calculation(doc=doc, documents_list=documents_list)
-            importance_dict[parent_key] += importance
-
-        return importance_dict
+        return dict(importance_dict)
 
     @staticmethod
-    def get_multi_query(question: str) -> list[str]:
+    def get_multi_query_prompt(question: str) -> list:
         # Set up the message template for multi query generation
         multi_query_template = ChatPromptTemplate.from_messages(
             [
@@ -106,9 +127,11 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
             ]
         )
         # Build the whole multi query prompt
-        multi_query_prompt = multi_query_template.format_messages(question=question)
+        return multi_query_template.format_messages(question=question)
+
+    def get_multi_query(self, question: str) -> list[str]:
         # Get multi queries using llm
-        response = prompt_based_generation(prompt=multi_query_prompt, model=MODEL,
+        response = prompt_based_generation(prompt=self.get_multi_query_prompt(question=question), model=MODEL,
                                            temperature=0.5, json_format=True)
         # Format multi queries
         multi_query = []
@@ -117,20 +140,36 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
 
         return multi_query
 
+    async def aget_multi_query(self, question: str) -> list[str]:
+        # Get multi queries using llm in Async way
+        response = await aprompt_based_generation(prompt=self.get_multi_query_prompt(question=question), model=MODEL,
+                                                  temperature=0.5, json_format=True)
+        # Format multi queries
+        multi_query = []
+        for query_key, query in response.items():
+            multi_query.append(query)
+
+        return multi_query
+
     @staticmethod
-    def get_sorted_parent_documents(knowledge_base: str, parent_documents_with_importance: dict) -> list[Document]:
-        # Set the chromaDB util to get all parent documents
-        chroma_db = ChromaDBUtil().load_vectorstore(persist_directory=knowledge_base.replace("child", "parent"))
+    def get_sorted_parent_documents_with_importance(knowledge_base: str,
+                                                    parent_documents_with_importance: dict) -> list[tuple[Document, float]]:
+        # Get all parent documents keyed by (source, index), loaded once per knowledge base
+        parent_documents_index = ChromaDBUtil().load_documents_index(
+            persist_directory=knowledge_base.replace("child", "parent"),
+            key_fields=('source', 'index'))
         parent_documents = []
         for (source, parent_index), importance in parent_documents_with_importance.items():
-            results = chroma_db.get(where={"$and": [{'index': parent_index},
-                                                    {'source': source}]})
-            for i, metadata in enumerate(results['metadatas']):
-                document = Document(page_content=results['documents'][i], metadata=metadata)
+            for document in parent_documents_index.get((source, parent_index), []):
                 parent_documents.append((document, importance))
 
         # Resort the parent document using their importance score
-        sorted_parent_documents = [doc for doc, _ in sorted(parent_documents, key=lambda x: x[1], reverse=True)]
+        return sorted(parent_documents, key=lambda x: x[1], reverse=True)
+
+    def get_sorted_parent_documents(self, knowledge_base: str, parent_documents_with_importance: dict) -> list[Document]:
+        sorted_parent_documents = [doc for doc, _ in self.get_sorted_parent_documents_with_importance(
+            knowledge_base=knowledge_base,
+            parent_documents_with_importance=parent_documents_with_importance)]
 
         return sorted_parent_documents
 
@@ -162,8 +201,7 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
                                                             metadata=parent_document.metadata))
         return compressed_parent_documents
 
-    @staticmethod
-    async def aget_compressed_parent_documents(sorted_parent_documents: list[Document],
+    async def aget_compressed_parent_documents(self, sorted_parent_documents_with_importance: list[tuple[Document, float]],
                                                question: str) -> list[Document]:
         # Set up the message template for contextual compression
         multi_query_template = ChatPromptTemplate.from_messages(
@@ -172,21 +210,63 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
                 HumanMessagePromptTemplate.from_template(CONTEXTUAL_COMPRESSION_PROMPT),
             ]
         )
+        # Skip the parent documents which are not important enough
+        candidates = [doc for doc, importance in sorted_parent_documents_with_importance
+                      if importance >= self.compression_min_importance]
+
+        # Compress parent documents in RRF order with bounded concurrency, until enough useful context is found
+        compressed_contents = [None] * len(candidates)
+        running_tasks = {}
+        next_index = 0
+        useful_num = 0
+        useful_tokens = 0
+        try:
+            while next_index < len(candidates) or running_tasks:
+                budget_reached = (useful_num >= self.compression_max_documents or
+                                  useful_tokens >= self.compression_token_budget)
+                # Start new compressions while there is a free slot and the budget is not reached
+                while not budget_reached and next_index < len(candidates) and \
+                        len(running_tasks) < self.compression_max_concurrency:
+                    prompt = multi_query_template.format_messages(question=question,
+                                                                  context=candidates[next_index].page_content)
+                    task = asyncio.create_task(aprompt_based_generation(prompt=prompt, model=MODEL, temperature=0.5))
+                    running_tasks[task] = next_index
+                    next_index += 1
+                if not running_tasks:
+                    break
 
+                # Wait for any compression to finish
+                done_tasks, _ = await asyncio.wait(running_tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done_tasks:
+                    i = running_tasks.pop(task)
+                    compressed_doc_content = task.result().content
+                    # Check if llm find any relevant context
+                    if not compressed_doc_content.lower() == 'NO OUTPUT STRING'.lower():
+                        compressed_contents[i] = compressed_doc_content
+                        useful_num += 1
+                        useful_tokens += estimate_tokens(compressed_doc_content, completion_tokens=0)
+        finally:
+            for task in running_tasks:
+                task.cancel()
+
+        # Keep the useful compressions in RRF order within the budget
         compressed_parent_documents = []
-        # Build the whole multi query prompt and Get compressed content using llm
-        tasks = [aprompt_based_generation(prompt=multi_query_template.format_messages(question=question,
-                                                                                      context=parent_document.page_content),
-                                          model=MODEL,
-                                          temperature=0.5) for parent_document in sorted_parent_documents]
-        compressed_doc_contents = await asyncio.gather(*tasks)
-
-        for i, compressed_doc_content in enumerate(compressed_doc_contents):
-            # Check if llm find any relevant context
-            if not compressed_doc_content.content.lower() == 'NO OUTPUT STRING'.lower():
-                # Store compressed parent document
-                compressed_parent_documents.append(Document(page_content=compressed_doc_content.content,
-                                                            metadata=sorted_parent_documents[i].metadata))
+        used_tokens = 0
+        for i, compressed_doc_content in enumerate(compressed_contents):
+            if compressed_doc_content is None:
+                continue
+            if len(compressed_parent_documents) >= self.compression_max_documents or \
+                    used_tokens >= self.compression_token_budget:
+                break
+            # Store compressed parent document
+            compressed_parent_documents.append(Document(page_content=compressed_doc_content,
+                                                        metadata=candidates[i].metadata))
+            used_tokens += estimate_tokens(compressed_doc_content, completion_tokens=0)
+
+        # Count how many llm calls the early cut-off saved
+        compression_counters['made'] += next_index
+        compression_counters['saved'] += len(sorted_parent_documents_with_importance) - next_index
+        compression_counters['below_importance'] += len(sorted_parent_documents_with_importance) - len(candidates)
         return compressed_parent_documents
 
     @staticmethod
@@ -228,13 +308,11 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
 
         # Get the Retrival Tool to Extract document objects from knowledge base
         retrieval_tool = RetrievalTool()
-        # Initialise the documents list and retrieve relevent documents for each query
-        documents_list = []
-        for query in multi_query:
-            documents_list.append(retrieval_tool.call(query=query,
-                                                      knowledge_base=knowledge_base,
-                                                      k_num=k_num,
-                                                      score_threshold=0.6))
+        # Retrieve relevent documents for all queries in one batch
+        documents_list = retrieval_tool.batch_call(queries=multi_query,
+                                                   knowledge_base=knowledge_base,
+                                                   k_num=k_num,
+                                                   score_threshold=0.6)
 
         # Get common documents using documents_list
         common_documents = self.get_common_documents(documents_list=documents_list)
@@ -289,17 +367,28 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
     async def _arun(self, question: str, knowledge_base: str, k_num: int = 20,
                     *args: Any, **kwargs: Any) -> Any:
         """Use the tool asynchronously."""
-        # Multi Query Set Up
-        multi_query = self.get_multi_query(question=question)
+        # Reuse the answer of a question asked before in the same document, unless a custom prompt changes the answer
+        # or a retry asks for a fresh one
+        if not kwargs and not refresh_completions.get():
+            return await tool_result_cache.aget_or_compute(
+                question=question,
+                knowledge_base=knowledge_base,
+                extra_key=(k_num,),
+                compute=lambda: self._aanswer_question(question=question, knowledge_base=knowledge_base, k_num=k_num))
+        return await self._aanswer_question(question=question, knowledge_base=knowledge_base, k_num=k_num, **kwargs)
+
+    async def _aanswer_question(self, question: str, knowledge_base: str, k_num: int = 20, **kwargs: Any) -> Any:
+        """To answer a question by retrieving extra knowledge in Async way"""
+        # Multi Query Set Up in Async way
+        multi_query = await self.aget_multi_query(question=question)
 
         # Get the Retrival Tool to Extract document objects from knowledge base
         retrieval_tool = RetrievalTool()
-        # Retrieve relevent documents for each query in Async way
-        tasks = [retrieval_tool.acall(query=query,
-                                      knowledge_base=knowledge_base,
-                                      k_num=k_num,
-                                      score_threshold=0.6) for query in multi_query]
-        documents_list = await asyncio.gather(*tasks)
+        # Retrieve relevent documents for all queries in one batch in Async way
+        documents_list = await retrieval_tool.abatch_call(queries=multi_query,
+                                                          knowledge_base=knowledge_base,
+                                                          k_num=k_num,
+                                                          score_threshold=0.6)
 
         # Get common documents using documents_list
         common_documents = self.get_common_documents(documents_list=documents_list)
@@ -307,13 +396,15 @@ class RetrievalQAWithLLMAndResortTool(BaseTool):
         parent_documents_with_importance = self.calculate_parents_importance(common_documents=common_documents,
                                                                              documents_list=documents_list)
 
-        # Get All Parent Documents and Resort Them Using RRF Algorithm
-        sorted_parent_documents = self.get_sorted_parent_documents(knowledge_base=knowledge_base,
-                                                                   parent_documents_with_importance=parent_documents_with_importance)
+        # Get All Parent Documents and Resort Them Using RRF Algorithm, in a worker thread to keep event loop free
+        sorted_parent_documents_with_importance = await asyncio.to_thread(
+            self.get_sorted_parent_documents_with_importance,
+            knowledge_base=knowledge_base,
+            parent_documents_with_importance=parent_documents_with_importance)
 
-        # Contextual Compression for Parent Documents
+        # Contextual Compression for Parent Documents, stop early when enough useful context is found
         compressed_parent_documents = await self.aget_compressed_parent_documents(
-            sorted_parent_documents=sorted_parent_documents,
+            sorted_parent_documents_with_importance=sorted_parent_documents_with_importance,
             question=question)
 
         # Long-Context Reorder
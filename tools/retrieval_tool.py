@@ -1,9 +1,11 @@
 """
 This tool can retrieve relevant fragments from an external knowledge_base based on the query you input.
 """
+import asyncio
 from typing import Type, Any
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import BaseTool
+from langchain_community.vectorstores.chroma import Chroma
 from langchain_core.documents import Document
 
 from util.chroma_db_util import ChromaDBUtil
@@ -42,15 +44,15 @@ class RetrievalTool(BaseTool):
         """
         # Set up the tool to process Chroma DB
         chroma_util = ChromaDBUtil()
-        # Get Vector store
-        vectorstore = chroma_util.load_vectorstore(persist_directory=knowledge_base)
-        # Get retriever for retrieval task
-        score_threshold = kwargs.get('score_threshold', 0.5)
-        retriever = vectorstore.as_retriever(search_type="similarity_score_threshold",
-                                             search_kwargs={"score_threshold": score_threshold,
-                                                            "k": k_num})
-        # Start to retrieve
-        documents = retriever.invoke(query)
+        # Get Vector store, kept open until the retrieval is done
+        with chroma_util.use_vectorstore(persist_directory=knowledge_base) as vectorstore:
+            # Get retriever for retrieval task
+            score_threshold = kwargs.get('score_threshold', 0.5)
+            retriever = vectorstore.as_retriever(search_type="similarity_score_threshold",
+                                                 search_kwargs={"score_threshold": score_threshold,
+                                                                "k": k_num})
+            # Start to retrieve
+            documents = retriever.invoke(query)
         return documents
 
     async def acall(self, query: str, knowledge_base: str, k_num: int = 6, *args: Any, **kwargs: Any) -> list[Document]:
@@ -67,13 +69,67 @@ class RetrievalTool(BaseTool):
         """Use the tool asynchronously."""
         # Set up the tool to process Chroma DB
         chroma_util = ChromaDBUtil()
-        # Get Vector store
-        vectorstore = chroma_util.load_vectorstore(persist_directory=knowledge_base)
-        # Get retriever for retrieval task
-        score_threshold = kwargs.get('score_threshold', 0.5)
-        retriever = vectorstore.as_retriever(search_type="similarity_score_threshold",
-                                             search_kwargs={"score_threshold": score_threshold,
-                                                            "k": k_num})
-        # Start to retrieve
-        documents = await retriever.ainvoke(query)
+        # Get Vector store, kept open until the retrieval is done
+        async with chroma_util.ause_vectorstore(persist_directory=knowledge_base) as vectorstore:
+            # Get retriever for retrieval task
+            score_threshold = kwargs.get('score_threshold', 0.5)
+            retriever = vectorstore.as_retriever(search_type="similarity_score_threshold",
+                                                 search_kwargs={"score_threshold": score_threshold,
+                                                                "k": k_num})
+            # Start to retrieve
+            documents = await retriever.ainvoke(query)
         return documents
+
+    @staticmethod
+    def search_by_vectors(vectorstore: Chroma, query_embeddings: list[list[float]], k_num: int,
+                          score_threshold: float) -> list[list[Document]]:
+        """
+        To search the collection with many query vectors in one multi-vector query
+        :return: a list of relevant documents for each query vector, the same as retriever.invoke() for each query
+        """
+        # Chroma rejects a query without vectors
+        if not query_embeddings:
+            return []
+        results = vectorstore._collection.query(query_embeddings=query_embeddings,
+                                                n_results=k_num,
+                                                include=["documents", "metadatas", "distances"])
+        # Convert distance into relevance score in the same way as the retriever does
+        relevance_score_fn = vectorstore._select_relevance_score_fn()
+        documents_list = []
+        for page_contents, metadatas, distances in zip(results['documents'], results['metadatas'],
+                                                       results['distances']):
+            documents_list.append([Document(page_content=page_content, metadata=metadata or {})
+                                   for page_content, metadata, distance in zip(page_contents, metadatas, distances)
+                                   if relevance_score_fn(distance) >= score_threshold])
+        return documents_list
+
+    def batch_call(self, queries: list[str], knowledge_base: str, k_num: int = 6,
+                   score_threshold: float = 0.5) -> list[list[Document]]:
+        """
+        To get K_num of relevant documents for each query,
+        embedding all queries in one request and searching them in one query
+        """
+        if not queries:
+            return []
+        # Get Vector store, kept open until the search is done
+        with ChromaDBUtil().use_vectorstore(persist_directory=knowledge_base) as vectorstore:
+            # Embed all queries together
+            query_embeddings = vectorstore.embeddings.embed_documents(queries)
+            return self.search_by_vectors(vectorstore=vectorstore, query_embeddings=query_embeddings,
+                                          k_num=k_num, score_threshold=score_threshold)
+
+    async def abatch_call(self, queries: list[str], knowledge_base: str, k_num: int = 6,
+                          score_threshold: float = 0.5) -> list[list[Document]]:
+        """
+        To get K_num of relevant documents for each query in Async way,
+        embedding all queries in one request and searching them in one query
+        """
+        if not queries:
+            return []
+        # Get Vector store, kept open until the search is done
+        async with ChromaDBUtil().ause_vectorstore(persist_directory=knowledge_base) as vectorstore:
+            # Embed all queries together
+            query_embeddings = await vectorstore.embeddings.aembed_documents(queries)
+            return await asyncio.to_thread(self.search_by_vectors, vectorstore=vectorstore,
+                                           query_embeddings=query_embeddings,
+                                           k_num=k_num, score_threshold=score_threshold)
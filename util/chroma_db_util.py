@@ -1,14 +1,19 @@
 """
 This tool is responsible for managing and retrieving the corresponding external knowledge base.
 """
-import os
+import asyncio
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager, asynccontextmanager
 
+from chromadb.api.client import SharedSystemClient
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_community.vectorstores.chroma import Chroma
 from langchain_core.documents import Document
-from langchain_openai import OpenAIEmbeddings
 from globalParameter import parameters
+from globalParameter.parameters import VECTORSTORE_CACHE_SIZE
+from util.embeddings import get_openai_embeddings
 
 
 class ChromaDBUtil:
@@ -17,6 +22,9 @@ class ChromaDBUtil:
         1. load chroma vectorstore
         2. initialise chroma vectorstore using pdf files or Document class (A class defined by langchain)
         3. load more pdf files or Document class into existing vectorstore
+    Loaded vectorstores are kept open in an LRU cache shared by all ChromaDBUtil objects,
+    so a knowledge base is opened once and not once per query.
+    A vectorstore used through use_vectorstore() or ause_vectorstore() is not closed until its last user is done.
     """
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
@@ -24,7 +32,75 @@ class ChromaDBUtil:
         length_function=len,
         is_separator_regex=False,
     )
-    embeddings_model = OpenAIEmbeddings(openai_api_key=os.environ.get("OPENAI_API_KEY"))
+    embeddings_model = get_openai_embeddings()
+    # Open vectorstores keyed by full persist directory, from least to most recently used
+    vectorstore_cache_size = VECTORSTORE_CACHE_SIZE
+    _open_vectorstores = OrderedDict()
+    _open_vectorstores_lock = threading.RLock()
+    # The number of callers using each open vectorstore, keyed by full persist directory
+    _vectorstore_users = Counter()
+    # In-memory indexes of all documents of an open vectorstore, keyed by full persist directory and key fields
+    _documents_indexes = {}
+    # Bumped whenever the indexes of a vectorstore are dropped, so an index read before that is not stored
+    _documents_index_versions = Counter()
+
+    @classmethod
+    def _cache_vectorstore(cls, persist_directory: str, vectorstore: Chroma):
+        """
+        To keep a vectorstore open for reuse and close the least recently used ones beyond the cache size
+        :param persist_directory: full vectorstore path
+        :param vectorstore: Chroma vectorstore opened on this path
+        """
+        with cls._open_vectorstores_lock:
+            cls._open_vectorstores[persist_directory] = vectorstore
+            cls._open_vectorstores.move_to_end(persist_directory)
+            cls._drop_documents_indexes(persist_directory=persist_directory)
+            cls._evict_vectorstores(keep_directory=persist_directory)
+
+    @classmethod
+    def _evict_vectorstores(cls, keep_directory: str = None):
+        """
+        To close the least recently used vectorstores beyond the cache size, skipping the ones in use
+        :param keep_directory: a full vectorstore path which is not closed either, e.g. the one just opened
+        """
+        with cls._open_vectorstores_lock:
+            for persist_directory in list(cls._open_vectorstores):
+                if len(cls._open_vectorstores) <= cls.vectorstore_cache_size:
+                    break
+                # The cache may stay over its size until the stores in use are released
+                if persist_directory == keep_directory or cls._vectorstore_users[persist_directory] > 0:
+                    continue
+                evicted_vectorstore = cls._open_vectorstores.pop(persist_directory)
+                cls._drop_documents_indexes(persist_directory=persist_directory)
+                cls.close_vectorstore(evicted_vectorstore)
+
+    @classmethod
+    def _drop_documents_indexes(cls, persist_directory: str):
+        cls._documents_index_versions[persist_directory] += 1
+        for index_key in [index_key for index_key in cls._documents_indexes if index_key[0] == persist_directory]:
+            del cls._documents_indexes[index_key]
+
+    @staticmethod
+    def close_vectorstore(vectorstore: Chroma):
+        """
+        To close a vectorstore and release its SQLite and HNSW files
+        :param vectorstore: Chroma vectorstore
+        """
+        # Chroma shares one system per path until it is removed from its system cache
+        system = SharedSystemClient._identifer_to_system.pop(vectorstore._client._identifier, None)
+        if system is not None:
+            system.stop()
+
+    @classmethod
+    def close_all_vectorstores(cls):
+        """
+        To close every vectorstore kept open for reuse, even the ones in use, e.g. when the process is done
+        """
+        with cls._open_vectorstores_lock:
+            cls._documents_indexes.clear()
+            while cls._open_vectorstores:
+                _, vectorstore = cls._open_vectorstores.popitem(last=False)
+                cls.close_vectorstore(vectorstore)
 
     def load_vectorstore(self, persist_directory: str) -> Chroma:
         """
@@ -34,10 +110,97 @@ class ChromaDBUtil:
         """
         # Get full vectorstore path
         persist_directory = "vectorDB/chromaDB/" + persist_directory
-        # Create an object for your chroma vectorstore
-        vectorstore = Chroma(persist_directory=persist_directory, embedding_function=self.embeddings_model)
+        with self._open_vectorstores_lock:
+            # Reuse the vectorstore if it is already open
+            vectorstore = self._open_vectorstores.get(persist_directory)
+            if vectorstore is not None:
+                self._open_vectorstores.move_to_end(persist_directory)
+                return vectorstore
+            # Create an object for your chroma vectorstore
+            vectorstore = Chroma(persist_directory=persist_directory, embedding_function=self.embeddings_model)
+            self._cache_vectorstore(persist_directory=persist_directory, vectorstore=vectorstore)
+        return vectorstore
+
+    def acquire_vectorstore(self, persist_directory: str) -> Chroma:
+        """
+        To Get a vectorstore using name and keep it open until release_vectorstore() is called with the same name
+        :param persist_directory: your vectorstore/knowledge name
+        :return: Chroma vectorstore
+        """
+        with self._open_vectorstores_lock:
+            vectorstore = self.load_vectorstore(persist_directory=persist_directory)
+            self._vectorstore_users["vectorDB/chromaDB/" + persist_directory] += 1
         return vectorstore
 
+    def release_vectorstore(self, persist_directory: str):
+        """
+        To let a vectorstore got by acquire_vectorstore() be closed again, once nobody else uses it
+        :param persist_directory: your vectorstore/knowledge name
+        """
+        with self._open_vectorstores_lock:
+            persist_directory = "vectorDB/chromaDB/" + persist_directory
+            self._vectorstore_users[persist_directory] -= 1
+            if self._vectorstore_users[persist_directory] <= 0:
+                del self._vectorstore_users[persist_directory]
+                # Close the stores whose eviction was skipped while they were in use
+                self._evict_vectorstores()
+
+    @contextmanager
+    def use_vectorstore(self, persist_directory: str):
+        """
+        Context manager that gives a vectorstore using name and keeps it open inside the context
+        :param persist_directory: your vectorstore/knowledge name
+        """
+        vectorstore = self.acquire_vectorstore(persist_directory=persist_directory)
+        try:
+            yield vectorstore
+        finally:
+            self.release_vectorstore(persist_directory=persist_directory)
+
+    @asynccontextmanager
+    async def ause_vectorstore(self, persist_directory: str):
+        """
+        Async context manager that gives a vectorstore using name and keeps it open inside the context
+        :param persist_directory: your vectorstore/knowledge name
+        """
+        # Opening a vectorstore may touch the disk, so do it in a worker thread
+        vectorstore = await asyncio.to_thread(self.acquire_vectorstore, persist_directory=persist_directory)
+        try:
+            yield vectorstore
+        finally:
+            self.release_vectorstore(persist_directory=persist_directory)
+
+    def load_documents_index(self, persist_directory: str,
+                             key_fields: tuple[str, ...] = ('source', 'index')) -> dict[tuple, list[Document]]:
+        """
+        To Get all documents of a vectorstore grouped by metadata fields, read once and kept in memory
+        :param persist_directory: your vectorstore/knowledge name
+        :param key_fields: the metadata fields used as the key of a document
+        :return: dict from the values of key fields to the documents with these values
+        """
+        index_key = ("vectorDB/chromaDB/" + persist_directory, key_fields)
+        with self._open_vectorstores_lock:
+            documents_index = self._documents_indexes.get(index_key)
+        if documents_index is not None:
+            return documents_index
+
+        # Read the whole collection in one call without the lock, so other knowledge bases are not blocked
+        with self.use_vectorstore(persist_directory=persist_directory) as vectorstore:
+            with self._open_vectorstores_lock:
+                version = self._documents_index_versions[index_key[0]]
+            results = vectorstore.get()
+        documents_index = {}
+        for page_content, metadata in zip(results['documents'], results['metadatas']):
+            key = tuple(metadata.get(key_field) for key_field in key_fields)
+            documents_index.setdefault(key, []).append(Document(page_content=page_content, metadata=metadata))
+
+        with self._open_vectorstores_lock:
+            # Keep the index only if the vectorstore has not changed while it was read
+            if self._documents_index_versions[index_key[0]] == version and \
+                    index_key[0] in self._open_vectorstores:
+                documents_index = self._documents_indexes.setdefault(index_key, documents_index)
+        return documents_index
+
     def initialise_vectorstore_with_documents(self, persist_directory: str, documents: list[Document]) -> Chroma:
         """
         To initialise a new vectorstore using Document class
@@ -50,6 +213,7 @@ class ChromaDBUtil:
         # Create an object for your chroma vectorstore using documents
         vectorstore = Chroma.from_documents(documents=documents, embedding=self.embeddings_model,
                                             persist_directory=persist_directory)
+        self._cache_vectorstore(persist_directory=persist_directory, vectorstore=vectorstore)
         return vectorstore
 
     def initialise_vectorstore_with_files(self, persist_directory: str, files: list[str]) -> Chroma:
@@ -97,6 +261,9 @@ class ChromaDBUtil:
         """
         texts = [doc.page_content for doc in documents]
         metadatas = [doc.metadata for doc in documents]
-        vectorstore = self.load_vectorstore(persist_directory=persist_directory)
-        vectorstore.add_texts(texts=texts, metadatas=metadatas)
+        with self.use_vectorstore(persist_directory=persist_directory) as vectorstore:
+            vectorstore.add_texts(texts=texts, metadatas=metadatas)
+        # The in-memory indexes of this vectorstore are out of date now
+        with self._open_vectorstores_lock:
+            self._drop_documents_indexes(persist_directory="vectorDB/chromaDB/" + persist_directory)
 
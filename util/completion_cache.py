@@ -0,0 +1,167 @@
+"""
+This Python file provides a persistent, content-addressed cache of LLM completions.
+A completion is stored under the hash of (model, messages, temperature, response_format),
+so re-running any generation or evaluation script with identical prompts costs no API call.
+The cache is a SQLite file with size- and age-based eviction of the least recently used entries.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.messages import HumanMessage, convert_to_messages, message_to_dict, messages_from_dict
+
+from globalParameter.parameters import COMPLETION_CACHE_MODE, COMPLETION_CACHE_PATH, COMPLETION_CACHE_MAX_MB, \
+    COMPLETION_CACHE_MAX_AGE_DAYS
+
+
+class CompletionCache:
+    """
+    Use this CompletionCache to:
+        1. build the cache key of a chat completion request
+        2. get a stored completion (a langchain message, or a dict for Json format)
+        3. store a new completion and evict old entries when the cache is too big or too old
+    """
+    # Check the size of cache every this many writes
+    evict_every = 100
+
+    def __init__(self, path: str, mode: str = "deterministic", max_mb: float = 1024, max_age_days: float = 30):
+        """
+        :param path: the SQLite file of cache
+        :param mode: 'deterministic' only caches calls with temperature 0, 'all' caches every call and so replays
+                     the first sampled answer of a temperature > 0 call, 'off' disables the cache
+        :param max_mb: the maximum size of cached completions in MB
+        :param max_age_days: entries not used for this many days are removed
+        """
+        if mode not in ("all", "deterministic", "off"):
+            raise ValueError(f"Unknown completion cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self._lock = threading.Lock()
+        self._connection = None
+        self._write_count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the cache only when it is used for the first time
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,
+                created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+            self._evict()
+        return self._connection
+
+    def is_enabled_for(self, temperature: float) -> bool:
+        """
+        To check if a call with this temperature should use the cache
+        :param temperature: the temperature of the call
+        :return: True if the call should be cached
+        """
+        if self.mode == "off":
+            return False
+        if self.mode == "deterministic":
+            return float(temperature) == 0.0
+        return True
+
+    @staticmethod
+    def make_key(prompt, model: str, temperature: float, json_format: bool) -> str:
+        """
+        To build the cache key of a request
+        :param prompt: a string or a list of messages, the same as you pass to the model
+        :param model: The name of model
+        :param temperature: The temperature of the call
+        :param json_format: True if the response is Json format
+        :return: sha256 hex digest of the request
+        """
+        if isinstance(prompt, str):
+            messages = [HumanMessage(content=prompt)]
+        elif hasattr(prompt, 'to_messages'):
+            messages = prompt.to_messages()
+        else:
+            messages = convert_to_messages(prompt)
+        request = {
+            'model': model,
+            'messages': [[message.type, message.content] for message in messages],
+            'temperature': float(temperature),
+            'response_format': 'json_object' if json_format else 'text',
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        To get a stored completion
+        :param key: the cache key from make_key()
+        :return: the completion, or None if it is not cached
+        """
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, accessed_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.max_age_seconds:
+                connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                connection.commit()
+                return None
+            connection.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+            connection.commit()
+
+        value = json.loads(row[0])
+        if 'json' in value:
+            return value['json']
+        return messages_from_dict([value['message']])[0]
+
+    def put(self, key: str, response):
+        """
+        To store a completion
+        :param key: the cache key from make_key()
+        :param response: the model output, a langchain message or a dict for Json format
+        """
+        if isinstance(response, dict):
+            value = json.dumps({'json': response}, ensure_ascii=False)
+        else:
+            value = json.dumps({'message': message_to_dict(response)}, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                               (key, value, len(value), now, now))
+            connection.commit()
+            self._write_count += 1
+            if self._write_count % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        """To remove expired entries and then the least recently used entries until the cache fits its size"""
+        connection = self._connection
+        connection.execute("DELETE FROM completions WHERE accessed_at < ?", (time.time() - self.max_age_seconds,))
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total_size > self.max_bytes:
+            freed = 0
+            keys = []
+            for key, size in connection.execute("SELECT key, size FROM completions ORDER BY accessed_at"):
+                if total_size - freed <= self.max_bytes:
+                    break
+                keys.append((key,))
+                freed += size
+            connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+        connection.commit()
+
+
+# Calls made while this is set skip the stored completions and overwrite them with fresh ones,
+# e.g. the retry of a call whose cached response could not be parsed
+refresh_completions = contextvars.ContextVar("refresh_completions", default=False)
+
+# The one completion cache shared by all LLM calls of this process
+completion_cache = CompletionCache(path=COMPLETION_CACHE_PATH,
+                                   mode=COMPLETION_CACHE_MODE,
+                                   max_mb=COMPLETION_CACHE_MAX_MB,
+                                   max_age_days=COMPLETION_CACHE_MAX_AGE_DAYS)
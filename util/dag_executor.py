@@ -0,0 +1,136 @@
+"""
+This Python file provides the executor of a DAG (directed acyclic graph) of async tasks.
+Each task starts as soon as all tasks it depends on are done, instead of waiting for a whole stage to finish,
+so stages such as drafting, refining and evaluating a section overlap across sections and files.
+"""
+import asyncio
+import time
+from collections import Counter
+
+from globalParameter.parameters import DAG_MAX_CONCURRENCY, PIPELINE_REPORT_INTERVAL
+from util.retry_policy import report_retry_counters
+
+
+class DagExecutor:
+    """
+    Use this DagExecutor to:
+        1. add async tasks together with the tasks they depend on
+        2. run each task as soon as its dependencies are done, under one cap on the number of running tasks
+        3. skip the tasks whose dependencies failed, and report the progress of each stage
+    Note:
+        A task id is a tuple whose first item is the name of its stage, e.g. ('refine', file_name, section_id)
+    """
+
+    def __init__(self, name: str, max_concurrency: int = DAG_MAX_CONCURRENCY,
+                 report_interval: float = PIPELINE_REPORT_INTERVAL):
+        """
+        :param name: the name of DAG shown in reports
+        :param max_concurrency: the number of tasks running at the same time
+        :param report_interval: the seconds between two progress reports
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.report_interval = report_interval
+
+        self._tasks = {}
+        self.results = {}
+        self.failed_tasks = {}
+        self.skipped_tasks = {}
+
+    def add_task(self, task_id: tuple, run, dependencies: list[tuple] = ()):
+        """
+        To add a task into the DAG
+        :param task_id: the id of task, whose first item is the name of its stage
+        :param run: async function(*dependency_results) running the task with the results of its dependencies
+        :param dependencies: the ids of tasks which must be done before this task
+        """
+        if task_id in self._tasks:
+            raise ValueError(f"Task {task_id} is already in the DAG")
+        self._tasks[task_id] = (run, list(dependencies))
+
+    def check(self):
+        """To check that all dependencies are in the DAG and there is no cycle"""
+        for task_id, (run, dependencies) in self._tasks.items():
+            for dependency in dependencies:
+                if dependency not in self._tasks:
+                    raise ValueError(f"Task {task_id} depends on {dependency}, which is not in the DAG")
+
+        # Kahn's algorithm: every task can be ordered only if there is no cycle
+        waiting_num = {task_id: len(dependencies) for task_id, (run, dependencies) in self._tasks.items()}
+        dependents = {task_id: [] for task_id in self._tasks}
+        for task_id, (run, dependencies) in self._tasks.items():
+            for dependency in dependencies:
+                dependents[dependency].append(task_id)
+        ready = [task_id for task_id, num in waiting_num.items() if num == 0]
+        ordered_num = 0
+        while ready:
+            task_id = ready.pop()
+            ordered_num += 1
+            for dependent in dependents[task_id]:
+                waiting_num[dependent] -= 1
+                if waiting_num[dependent] == 0:
+                    ready.append(dependent)
+        if ordered_num != len(self._tasks):
+            raise ValueError("The DAG has a cycle")
+
+    async def run(self) -> dict:
+        """
+        To run all tasks of the DAG
+        :return: results of the tasks which are done, keyed by task id
+        """
+        self.check()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._done_events = {task_id: asyncio.Event() for task_id in self._tasks}
+        self._running = Counter()
+        self._start_time = time.perf_counter()
+
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*[self._run_task(task_id=task_id) for task_id in self._tasks])
+        finally:
+            reporter.cancel()
+
+        print(f"[{self.name}] finished: {self.report()}")
+        print(f"[{self.name}] errors by class: {report_retry_counters()}")
+        for task_id, error in self.failed_tasks.items():
+            print(f"[{self.name}] FAILED {task_id}: {error}")
+        return self.results
+
+    async def _run_task(self, task_id: tuple):
+        run, dependencies = self._tasks[task_id]
+        try:
+            # Wait for all dependencies, and skip the task if any of them is not done
+            for dependency in dependencies:
+                await self._done_events[dependency].wait()
+                if dependency not in self.results:
+                    self.skipped_tasks[task_id] = dependency
+                    return
+
+            async with self._semaphore:
+                self._running[task_id[0]] += 1
+                try:
+                    self.results[task_id] = await run(*[self.results[dependency] for dependency in dependencies])
+                except Exception as e:
+                    self.failed_tasks[task_id] = repr(e)
+                    print(f"[{self.name}] {task_id} failed: {e!r}")
+                finally:
+                    self._running[task_id[0]] -= 1
+        finally:
+            self._done_events[task_id].set()
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print(f"[{self.name}] progress: {self.report()}")
+
+    def report(self) -> str:
+        """
+        To Get the progress of each stage
+        :return: one line report
+        """
+        total = Counter(task_id[0] for task_id in self._tasks)
+        done = Counter(task_id[0] for task_id in self.results)
+        failed = Counter(task_id[0] for task_id in list(self.failed_tasks) + list(self.skipped_tasks))
+        stages = ", ".join(f"{stage} {done[stage]}/{total[stage]} ({self._running[stage]} running, {failed[stage]} failed)"
+                           for stage in total)
+        return f"{stages}, {time.perf_counter() - self._start_time:.0f} s elapsed"
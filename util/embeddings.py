@@ -0,0 +1,141 @@
+"""
+This Python file provides the embeddings models used by the knowledge bases and the evaluation.
+Every embeddings request goes through the global rate limiter in util/rate_limiter.py,
+and every vector is cached on disk by text hash and model name, so the same text is only embedded once.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from globalParameter.parameters import EMBEDDING_CACHE_PATH
+from util.openai_clients import create_openai_embeddings
+from util.rate_limiter import estimate_tokens, run_with_rate_limit, arun_with_rate_limit
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    A wrapper which sends every request of an OpenAIEmbeddings model through the global rate limiter
+    """
+
+    def __init__(self, embeddings_model: OpenAIEmbeddings):
+        self.embeddings_model = embeddings_model
+
+    def _estimate(self, texts: list[str]) -> tuple[int, int]:
+        # OpenAIEmbeddings splits the texts into requests of chunk_size texts each
+        requests = max(1, math.ceil(len(texts) / self.embeddings_model.chunk_size))
+        return estimate_tokens(texts, completion_tokens=0), requests
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        tokens, requests = self._estimate(texts)
+        return run_with_rate_limit(lambda: self.embeddings_model.embed_documents(texts),
+                                   tokens=tokens, requests=requests)
+
+    def embed_query(self, text: str) -> list[float]:
+        tokens, requests = self._estimate([text])
+        return run_with_rate_limit(lambda: self.embeddings_model.embed_query(text),
+                                   tokens=tokens, requests=requests)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        tokens, requests = self._estimate(texts)
+        return await arun_with_rate_limit(lambda: self.embeddings_model.aembed_documents(texts),
+                                          tokens=tokens, requests=requests)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        tokens, requests = self._estimate([text])
+        return await arun_with_rate_limit(lambda: self.embeddings_model.aembed_query(text),
+                                          tokens=tokens, requests=requests)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    A wrapper which stores the vectors of an embeddings model in SQLite as float32 blobs, keyed by text hash and model.
+    Only the texts missing from the cache are sent to the model, all in one batch.
+    """
+    # SQLite limits the number of variables in one statement
+    lookup_batch_size = 500
+
+    def __init__(self, embeddings_model: Embeddings, model_name: str, path: str = EMBEDDING_CACHE_PATH):
+        """
+        :param embeddings_model: the embeddings model which computes the vectors missing from cache
+        :param model_name: the name of model, part of the cache key
+        :param path: the SQLite file of cache
+        """
+        self.embeddings_model = embeddings_model
+        self.model_name = model_name
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the cache only when it is used for the first time
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        return self._connection
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _lookup(self, texts: list[str]) -> tuple[dict, list[str]]:
+        """
+        To get the cached vectors of texts
+        :return: dict from text to vector, and the unique texts missing from cache
+        """
+        keys = {self._key(text): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(key_list), self.lookup_batch_size):
+                batch = key_list[i:i + self.lookup_batch_size]
+                rows = connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                                          batch)
+                for key, vector in rows:
+                    found[keys[key]] = np.frombuffer(vector, dtype=np.float32).tolist()
+        missing = [text for text in keys.values() if text not in found]
+        return found, missing
+
+    def _store(self, texts: list[str], vectors: list[list[float]]) -> dict:
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        rows = [(self._key(text), vector.tobytes()) for text, vector in zip(texts, vectors)]
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", rows)
+            connection.commit()
+        # Return the float32 values, so a cache miss and a cache hit give the same vector
+        return {text: vector.tolist() for text, vector in zip(texts, vectors)}
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        found, missing = self._lookup(texts)
+        if missing:
+            found.update(self._store(missing, self.embeddings_model.embed_documents(missing)))
+        return [found[text] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        found, missing = self._lookup(texts)
+        if missing:
+            found.update(self._store(missing, await self.embeddings_model.aembed_documents(missing)))
+        return [found[text] for text in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def get_openai_embeddings() -> CachedEmbeddings:
+    """
+    To Get an OpenAI embeddings model whose requests are cached on disk and scheduled by the global rate limiter
+    :return: cached, rate limited embeddings model
+    """
+    openai_embeddings = create_openai_embeddings(openai_api_key=os.environ.get("OPENAI_API_KEY"))
+    return CachedEmbeddings(RateLimitedEmbeddings(openai_embeddings), model_name=openai_embeddings.model)
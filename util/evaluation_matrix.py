@@ -1,25 +1,68 @@
 import asyncio
-import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+
 import numpy as np
 import nltk
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
-from langchain_openai import OpenAIEmbeddings
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 from nltk.translate import meteor_score
+from nltk.corpus import wordnet
 from nltk.tokenize import word_tokenize
 from rouge import Rouge
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
+from globalParameter.parameters import METRIC_PROCESS_NUM, EVALUATION_EMBEDDING_BATCH_SIZE, NLTK_AUTO_DOWNLOAD, \
+    BLEURT_MODEL, BLEURT_BATCH_SIZE
 from prompt.prompt_of_gpt_self_evaluation import GPT_SELF_EVALUATION_SYSTEM, GPT_SELF_EVALUATION_PROMPT
+from util.embeddings import get_openai_embeddings
 from util.prompt_based_generation import prompt_based_generation, aprompt_based_generation
+from util.retry_policy import RetryPolicy
+from util.summary_store import summary_store
+
+# One ROUGE scorer of ROUGE-1 and ROUGE-L shared by all sections
+rouge = Rouge(metrics=['rouge-l', 'rouge-1'])
+
+# Retry policy of the calls of GPT self evaluation
+gpt_self_evaluation_retry_policy = RetryPolicy(name="GPT self evaluation")
 
-nltk.download("wordnet")
-nltk.download('omw-1.4')
-nltk.download('punkt')
+# The NLTK data used by the metrics, as (path in NLTK data, package to download)
+NLTK_RESOURCES = [('corpora/wordnet', 'wordnet'), ('corpora/omw-1.4', 'omw-1.4'), ('tokenizers/punkt', 'punkt')]
 
-tokenizer = AutoTokenizer.from_pretrained("Elron/bleurt-base-512")
-model = AutoModelForSequenceClassification.from_pretrained("Elron/bleurt-base-512")
+# The process pool of the CPU bound metrics, the embeddings model and the BLEURT model of evaluation, created on first use
+_metric_process_pool = None
+_evaluation_embeddings_model = None
+_bleurt = None
+_nltk_resources_ready = False
+_resources_lock = threading.Lock()
+
+
+def ensure_nltk_resources():
+    """
+    To check that the NLTK data of the metrics is on disk, downloading only the missing packages
+    Note:
+        Nothing is downloaded when the data is found, so the metrics work offline once the data exists
+    """
+    global _nltk_resources_ready
+    if _nltk_resources_ready:
+        return
+    with _resources_lock:
+        if _nltk_resources_ready:
+            return
+        for resource_path, package in NLTK_RESOURCES:
+            try:
+                nltk.data.find(resource_path)
+            except LookupError:
+                if not NLTK_AUTO_DOWNLOAD or not nltk.download(package):
+                    raise LookupError(f"The NLTK package '{package}' is missing, "
+                                      f"run: python -m nltk.downloader {package}")
+        _nltk_resources_ready = True
+
+
+def tokenize(text: str) -> list[str]:
+    ensure_nltk_resources()
+    return word_tokenize(text)
 
 
 def cosine_similarity(embeddings1, embeddings2):
@@ -31,6 +74,114 @@ def cosine_similarity(embeddings1, embeddings2):
     return similarity
 
 
+class MetricInputs:
+    """
+    Use this MetricInputs to:
+        1. hold the generation text and target text of a section
+        2. tokenize each text only once, and share the tokens and ROUGE scores among all metrics of the section
+    """
+
+    def __init__(self, generation_text: str, target_text: str):
+        self.generation_text = generation_text
+        self.target_text = target_text
+
+    @cached_property
+    def candidate_tokens(self) -> list[str]:
+        return tokenize(self.generation_text)
+
+    @cached_property
+    def reference_tokens(self) -> list[str]:
+        return tokenize(self.target_text)
+
+    @cached_property
+    def rouge_scores(self) -> dict:
+        # ROUGE-1 and ROUGE-L come from one pass of rouge, which tokenizes the texts in its own way
+        return rouge.get_scores(self.generation_text, self.target_text, avg=True)
+
+
+# The metrics calculated from the shared inputs of a section, keyed by the name in the evaluation matrix
+metric_registry = {}
+
+
+def register_metric(name: str):
+    """
+    To register a metric into the metric engine, e.g.
+        @register_metric('BLEU')
+        def bleu_metric(inputs: MetricInputs) -> float: ...
+    :param name: the name of metric in the evaluation matrix
+    :return: decorator of function(inputs: MetricInputs) returning the score
+    """
+    def decorator(metric):
+        metric_registry[name] = metric
+        return metric
+    return decorator
+
+
+def calculate_metrics(generation_text: str, target_text: str, metric_names: list[str] = None) -> dict:
+    """
+    To calculate the registered metrics of a section, tokenizing the generation and target text only once
+    :param generation_text: The text you want to evaluate
+    :param target_text: Your target example
+    :param metric_names: the metrics to calculate, None for all registered metrics
+    :return: scores keyed by metric name
+    """
+    inputs = MetricInputs(generation_text=generation_text, target_text=target_text)
+    return {metric_name: metric_registry[metric_name](inputs) for metric_name in (metric_names or metric_registry)}
+
+
+def _init_metric_worker():
+    # Load WordNet and punkt once per worker, instead of inside the first METEOR of the worker
+    ensure_nltk_resources()
+    wordnet.ensure_loaded()
+    word_tokenize("warm up")
+
+
+def get_metric_process_pool() -> ProcessPoolExecutor:
+    """To Get the process pool calculating the registered metrics, one worker per core by default"""
+    global _metric_process_pool
+    if _metric_process_pool is None:
+        # Download the missing NLTK data once here, instead of in every worker at the same time
+        ensure_nltk_resources()
+        _metric_process_pool = ProcessPoolExecutor(max_workers=METRIC_PROCESS_NUM, initializer=_init_metric_worker)
+    return _metric_process_pool
+
+
+async def acalculate_metrics(generation_text: str, target_text: str, metric_names: list[str] = None) -> dict:
+    """
+    To calculate the registered metrics of a section in the metric process pool, without blocking the event loop
+    :param generation_text: The text you want to evaluate
+    :param target_text: Your target example
+    :param metric_names: the metrics to calculate, None for all registered metrics
+    :return: scores keyed by metric name
+    Note:
+        With the fork start method of Linux, the metrics registered before the first call are available in the workers
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_metric_process_pool(), calculate_metrics,
+                                                            generation_text, target_text, metric_names)
+
+
+@register_metric('BLEU')
+def bleu_metric(inputs: MetricInputs) -> float:
+    smoothie = SmoothingFunction().method4
+    return float(sentence_bleu([inputs.reference_tokens], inputs.candidate_tokens, smoothing_function=smoothie))
+
+
+@register_metric('METEOR')
+def meteor_metric(inputs: MetricInputs) -> float:
+    ensure_nltk_resources()
+    return float(meteor_score.meteor_score([inputs.reference_tokens], inputs.candidate_tokens))
+
+
+@register_metric('ROUGE_1')
+def rouge_1_metric(inputs: MetricInputs) -> float:
+    return inputs.rouge_scores['rouge-1']['f']
+
+
+@register_metric('ROUGE_L')
+def rouge_l_metric(inputs: MetricInputs) -> float:
+    return inputs.rouge_scores['rouge-l']['f']
+
+
 def calculate_BLEU(generation_text: str, target_text: str) -> float:
     """
     BLEU can evaluate the lexical overlap between two texts,
@@ -40,14 +191,7 @@ def calculate_BLEU(generation_text: str, target_text: str) -> float:
     :param target_text: Your target example
     :return: BLEU score
     """
-    reference_tokens = [word_tokenize(target_text)]
-    candidate_tokens = word_tokenize(generation_text)
-
-    smoothie = SmoothingFunction().method4
-
-    bleu_result = sentence_bleu(reference_tokens, candidate_tokens, smoothing_function=smoothie)
-
-    return float(bleu_result)
+    return bleu_metric(MetricInputs(generation_text=generation_text, target_text=target_text))
 
 
 def calculate_METEOR(generation_text: str, target_text: str) -> float:
@@ -59,35 +203,38 @@ def calculate_METEOR(generation_text: str, target_text: str) -> float:
     :param target_text: Your target example
     :return: METEOR score
     """
-    reference_tokens = [word_tokenize(target_text)]
-    candidate_tokens = word_tokenize(generation_text)
+    return meteor_metric(MetricInputs(generation_text=generation_text, target_text=target_text))
 
-    meteor_result = meteor_score.meteor_score(reference_tokens, candidate_tokens)
 
-    return float(meteor_result)
-
-
-async def calculate_METEOR_of_summary(generation_text: str, target_text: str) -> float:
+async def calculate_METEOR_of_summary(generation_text: str, target_text: str, file_name_without_extension: str = None,
+                                      section_id: str = None, model: str = 'gpt-4o') -> float:
     """
     METEOR evaluates the similarity between two texts, considering synonyms, roots, and suffixes.
     However, it is sensitive to the order of generated sentences,
     which can lead to a lower score for sentences that have the same meaning but different word orders.
     :param generation_text: The text you want to evaluate
     :param target_text: Your target example
+    :param file_name_without_extension: the file of target, with section_id the summary of target is shared by all versions
+    :param section_id: the section of target
+    :param model: The name of model which summarizes the texts
     :return: METEOR score
     """
+    # Summaries are read from the summary store, so only texts summarized for the first time cost an API call
+    if file_name_without_extension is not None and section_id is not None:
+        target_key = summary_store.reference_key(file_name_without_extension=file_name_without_extension,
+                                                 section_id=section_id, model=model)
+    else:
+        target_key = summary_store.generation_key(text=target_text, model=model)
     tasks = [
-        aprompt_based_generation(prompt=f"please summarize the following section context:\n{generation_text}", model='gpt-4o', temperature=0),
-        aprompt_based_generation(prompt=f"please summarize the following section context:\n{target_text}", model='gpt-4o', temperature=0)
+        summary_store.asummarize(key=summary_store.generation_key(text=generation_text, model=model),
+                                 text=generation_text, model=model),
+        summary_store.asummarize(key=target_key, text=target_text, model=model)
     ]
     response = await asyncio.gather(*tasks)
 
-    reference_tokens = [word_tokenize(response[1].content)]
-    candidate_tokens = word_tokenize(response[0].content)
-
-    meteor_result = meteor_score.meteor_score(reference_tokens, candidate_tokens)
-
-    return float(meteor_result)
+    # The tokenization and WordNet lookups of METEOR run in the metric process pool, not on the event loop
+    scores = await acalculate_metrics(generation_text=response[0], target_text=response[1], metric_names=['METEOR'])
+    return scores['METEOR']
 
 
 def calculate_ROUGE(generation_text: str, target_text: str) -> dict:
@@ -99,11 +246,15 @@ def calculate_ROUGE(generation_text: str, target_text: str) -> dict:
     :param target_text: Your target example
     :return: ROUGE-L score
     """
-    rouge = Rouge(metrics=['rouge-l', 'rouge-1'])
+    return MetricInputs(generation_text=generation_text, target_text=target_text).rouge_scores
 
-    rouge_result = rouge.get_scores(generation_text, target_text, avg=True)
 
-    return rouge_result
+def get_evaluation_embeddings_model():
+    """To Get the embeddings model shared by all embedding similarity calculations, created on first use"""
+    global _evaluation_embeddings_model
+    if _evaluation_embeddings_model is None:
+        _evaluation_embeddings_model = get_openai_embeddings()
+    return _evaluation_embeddings_model
 
 
 def calculate_Embedding_similarity_of_consine(generation_text: str, target_text: str) -> float:
@@ -116,7 +267,7 @@ def calculate_Embedding_similarity_of_consine(generation_text: str, target_text:
     :param target_text: Your target example
     :return: BLEURT score
     """
-    embeddings_model = OpenAIEmbeddings(openai_api_key=os.environ.get("OPENAI_API_KEY"))
+    embeddings_model = get_evaluation_embeddings_model()
     embeddings = embeddings_model.embed_documents(
         [
             generation_text,
@@ -128,6 +279,81 @@ def calculate_Embedding_similarity_of_consine(generation_text: str, target_text:
     return float(embedding_similarity_of_cosine)
 
 
+async def acalculate_Embedding_similarities_of_cosine(text_pairs: list[tuple[str, str]],
+                                                      batch_size: int = EVALUATION_EMBEDDING_BATCH_SIZE) -> list[float]:
+    """
+    To calculate the embedding similarity of cosine of many (generation text, target text) pairs at once,
+    e.g. all sections of a file or of a whole version.
+    Each unique text is embedded once, in batches of batch_size texts, and texts embedded in the past
+    (e.g. the target texts shared by all versions) come from the embedding cache.
+    :param text_pairs: list of (generation text, target text)
+    :param batch_size: the number of texts in one embeddings call
+    :return: similarities in the order of text_pairs
+    """
+    if not text_pairs:
+        return []
+    unique_texts = list(dict.fromkeys(text for text_pair in text_pairs for text in text_pair))
+    embeddings_model = get_evaluation_embeddings_model()
+    batches = await asyncio.gather(*[embeddings_model.aembed_documents(unique_texts[i:i + batch_size])
+                                     for i in range(0, len(unique_texts), batch_size)])
+    text_index = {text: i for i, text in enumerate(unique_texts)}
+    vectors = np.asarray([vector for batch in batches for vector in batch], dtype=np.float32)
+
+    # Normalize every vector once, then the cosine of each pair is the row wise dot product
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    generation_vectors = vectors[[text_index[generation_text] for generation_text, target_text in text_pairs]]
+    target_vectors = vectors[[text_index[target_text] for generation_text, target_text in text_pairs]]
+    return np.einsum('ij,ij->i', generation_vectors, target_vectors).astype(float).tolist()
+
+
+def get_bleurt() -> tuple:
+    """
+    To Get the BLEURT tokenizer and model on CPU in evaluation mode, loaded on first use
+    :return: tokenizer, model
+    """
+    global _bleurt
+    with _resources_lock:
+        if _bleurt is None:
+            # transformers and torch are only imported when BLEURT is used
+            from transformers import AutoTokenizer, AutoModelForSequenceClassification
+            tokenizer = AutoTokenizer.from_pretrained(BLEURT_MODEL)
+            model = AutoModelForSequenceClassification.from_pretrained(BLEURT_MODEL)
+            model.eval()
+            _bleurt = (tokenizer, model)
+        return _bleurt
+
+
+def calculate_BLEURT(text_pairs: list[tuple[str, str]], batch_size: int = BLEURT_BATCH_SIZE) -> list[float]:
+    """
+    BLEURT is a BERT model fine-tuned on human ratings, which judges whether the generation text
+    says the same thing as the target text, beyond lexical overlap.
+    However, it is much slower than lexical metrics and only reads the first 512 tokens of the texts.
+    All pairs, e.g. all sections of a file, are scored on CPU without gradients in batches of batch_size pairs.
+    :param text_pairs: list of (generation text, target text)
+    :param batch_size: the number of pairs in one forward pass
+    :return: BLEURT scores in the order of text_pairs
+    """
+    import torch
+
+    tokenizer, model = get_bleurt()
+    # Pairs of similar length share a batch, so there is little padding
+    order = sorted(range(len(text_pairs)), key=lambda i: len(text_pairs[i][0]) + len(text_pairs[i][1]))
+    scores = [0.0] * len(text_pairs)
+    with torch.no_grad():
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i + batch_size]
+            inputs = tokenizer([text_pairs[j][1] for j in batch], [text_pairs[j][0] for j in batch],
+                               padding='longest', truncation=True, max_length=512, return_tensors='pt')
+            for j, score in zip(batch, model(**inputs).logits.flatten().tolist()):
+                scores[j] = score
+    return scores
+
+
+async def acalculate_BLEURT(text_pairs: list[tuple[str, str]], batch_size: int = BLEURT_BATCH_SIZE) -> list[float]:
+    """To calculate the BLEURT scores of calculate_BLEURT() in a thread, without blocking the event loop"""
+    return await asyncio.to_thread(calculate_BLEURT, text_pairs=text_pairs, batch_size=batch_size)
+
+
 async def calculate_GPT_SELF_EVALUATION(generation_text: str, target_text: str,
                                   template_requirement: str) -> dict:
     """
@@ -148,16 +374,13 @@ async def calculate_GPT_SELF_EVALUATION(generation_text: str, target_text: str,
     messages = chat_template.format_messages(template_requirement=template_requirement,
                                              generation_text=generation_text, target_text=target_text)
 
-    while 1:
-        try:
-            response = await aprompt_based_generation(prompt=messages, model='gpt-4o', temperature=0.5, json_format=True)
-            break
-        except Exception as e:
-            print(e)
-
-    gpt_self_evaluation_result = {
-        'reason': response['reason'],
-        'score': float(response['score'])
-    }
+    async def evaluate() -> dict:
+        response = await aprompt_based_generation(prompt=messages, model='gpt-4o', temperature=0.5, json_format=True)
+        return {
+            'reason': response['reason'],
+            'score': float(response['score'])
+        }
+
+    gpt_self_evaluation_result = await gpt_self_evaluation_retry_policy.arun(evaluate)
 
     return gpt_self_evaluation_result
@@ -0,0 +1,105 @@
+"""
+This Python file provides the key fact sheet of a document, a stage run once per document before its sections start.
+The detailed tables of all sections share many keys (project name, start date, stakeholders ...),
+so the keys of all sections are deduplicated and each unique key is answered once,
+and every section reads its key infos from the fact index instead of retrieving them again.
+Two keys are the same only if both their names and their descriptions are the same, because sections often
+use one key name for different questions, e.g. project_summary of sustainable development and of the scope.
+The answered keys, and the keys not found in the document, are saved to key_fact_sheet/{DOMAIN}/version_N/<file>.json,
+so a resumed run only asks the keys which failed.
+"""
+import json
+import os
+import re
+
+from globalParameter.parameters import DOMAIN
+from util.key_info_retrieval import aretrieve_key_infos
+
+
+def normalize_key_name(key_name: str) -> str:
+    # 'projectLocation', 'Project Location' and 'project_location' are the same key
+    key_name = re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", key_name.strip())
+    return re.sub(r"[\s\-_]+", "_", key_name).lower()
+
+
+class KeyFactSheet:
+    """
+    Use this KeyFactSheet to:
+        1. deduplicate the keys of the detailed tables of all sections
+        2. answer each unique key of a document once, and save the answers as the fact index of the document
+        3. Get the key infos of a section from the fact index
+    """
+
+    def __init__(self, generation_version: str, file_name_without_extension: str, detailed_table: dict, answer_key):
+        """
+        :param generation_version: the version of generation, e.g. '4' or '5'
+        :param file_name_without_extension: the file you are generating
+        :param detailed_table: the detailed tables of all sections, from section id to {'detailed_table': {key: description}}
+        :param answer_key: async function(key_name, key_description) returning the answer of a retrieval QA tool
+        """
+        self.file_name_without_extension = file_name_without_extension
+        self.detailed_table = detailed_table
+        self.answer_key = answer_key
+        self.path = f"key_fact_sheet/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.json"
+        self.facts = None
+
+    def get_unique_keys(self) -> dict:
+        """
+        To Get the unique keys of all sections, in template order
+        :return: {(normalized key name, key description): key name of its first section}
+        """
+        unique_keys = {}
+        for section in self.detailed_table.values():
+            for key_name, key_description in (section['detailed_table'] or {}).items():
+                unique_keys.setdefault((normalize_key_name(key_name), key_description), key_name)
+        return unique_keys
+
+    async def abuild(self):
+        """
+        To answer every unique key once, before the sections of the document start
+        Note:
+            Keys not found in the document are saved with a None answer,
+            and only the keys which failed after all retries in a past run are asked again
+        """
+        # The fact index maps normalized key name to {key description: answer or None if not found}
+        facts = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                facts = json.load(f)
+            # A fact index of the old format, keyed by key name only, merged different questions and is asked again
+            facts = {key_name: answers for key_name, answers in facts.items() if isinstance(answers, dict)}
+
+        unique_keys = self.get_unique_keys()
+        missing_keys = [(key_name, key_description)
+                        for (normalized_key_name, key_description), key_name in unique_keys.items()
+                        if key_description not in facts.get(normalized_key_name, {})]
+        if missing_keys:
+            print(f"{self.file_name_without_extension} key fact sheet: {len(missing_keys)} keys to answer of "
+                  f"{len(unique_keys)} unique keys of "
+                  f"{sum(len(section['detailed_table'] or {}) for section in self.detailed_table.values())} section keys")
+            key_infos = await aretrieve_key_infos(section_key_table=missing_keys, answer_key=self.answer_key)
+            for key_info in key_infos:
+                if not key_info['key_info/failed']:
+                    facts.setdefault(normalize_key_name(key_info['key_name']), {})[key_info['key_description']] = \
+                        key_info['key_info/answer']
+
+            # Write to a temporary file first, so a crash never leaves a half written fact index
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(facts, f, indent=4, ensure_ascii=False)
+            os.replace(f"{self.path}.tmp", self.path)
+        self.facts = facts
+
+    def get_section_key_infos(self, section_id: str) -> list[dict]:
+        """
+        To Get the key infos of a section from the fact index, which must have been built by abuild()
+        :param section_id: the id of section
+        :return: key infos in the order of the detailed table of section, None for keys without answer
+        """
+        if self.facts is None:
+            raise RuntimeError(f"The key fact sheet of {self.file_name_without_extension} has not been built")
+        return [{
+            'key_name': key_name,
+            'key_description': key_description,
+            'key_info/answer': self.facts.get(normalize_key_name(key_name), {}).get(key_description)
+        } for key_name, key_description in (self.detailed_table[section_id]['detailed_table'] or {}).items()]
@@ -0,0 +1,53 @@
+"""
+This Python file provides the retrieval of key infos of a section.
+All keys of the detailed table of a section are retrieved and answered concurrently,
+each under its own timeout and retry policy, and the key infos are returned in the order of the table.
+"""
+import asyncio
+
+from globalParameter.parameters import KEY_INFO_TIMEOUT, KEY_INFO_RETRY_NUM
+from util.retry_policy import RetryPolicy
+
+
+async def aretrieve_key_infos(section_key_table: dict, answer_key, timeout: float = KEY_INFO_TIMEOUT,
+                              retry_num: int = KEY_INFO_RETRY_NUM) -> list[dict]:
+    """
+    To retrieve the key infos of a section concurrently
+    :param section_key_table: the detailed table of section, from key name to key description,
+                              or a list of (key name, key description) when key names repeat
+    :param answer_key: async function(key_name, key_description) returning the answer of a retrieval QA tool
+    :param timeout: the seconds one try of a key can take
+    :param retry_num: the number of retries of a key before its answer is set to None
+    :return: key infos in the order of section_key_table, 'key_info/failed' is True if the key failed after all
+             retries, and False if it was answered or could not be found in the document
+    """
+    key_info_retry_policy = RetryPolicy(name="key info", max_attempts=retry_num + 1, timeout=timeout)
+
+    async def answer_key_info(key_name: str, key_description: str):
+        answer = await answer_key(key_name, key_description)
+        # Check if the model can find correct answer
+        if answer['find_answer_in_extracted_part'].lower() == 'YES'.lower():
+            return answer['answer']
+        return None
+
+    async def retrieve_key_info(key_name: str, key_description: str) -> dict:
+        key_failed = False
+        try:
+            key_answer = await key_info_retry_policy.arun(lambda: answer_key_info(key_name, key_description),
+                                                          label=f"key '{key_name}'")
+        except Exception:
+            key_answer = None
+            key_failed = True
+
+        # Store the key info
+        return {
+            'key_name': key_name,
+            'key_description': key_description,
+            'key_info/answer': key_answer,
+            'key_info/failed': key_failed
+        }
+
+    if isinstance(section_key_table, dict):
+        section_key_table = section_key_table.items()
+    return await asyncio.gather(*[retrieve_key_info(key_name=key_name, key_description=key_description)
+                                  for key_name, key_description in section_key_table])
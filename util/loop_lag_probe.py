@@ -0,0 +1,53 @@
+"""
+This Python file provides a probe that measures how long the asyncio event loop is blocked.
+The probe sleeps for a short interval again and again; any extra delay before it wakes up
+is time in which the loop could not run other coroutines.
+"""
+import asyncio
+import time
+
+
+class LoopLagProbe:
+    """
+    Use this LoopLagProbe as an async context manager around the code you want to check:
+        async with LoopLagProbe() as probe:
+            await some_tool.acall(...)
+        print(probe.report())
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        :param interval: the seconds between two samples
+        """
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    @property
+    def max_lag(self) -> float:
+        return max(self.lags, default=0.0)
+
+    @property
+    def mean_lag(self) -> float:
+        return sum(self.lags) / len(self.lags) if self.lags else 0.0
+
+    def report(self) -> str:
+        return (f"loop lag over {len(self.lags)} samples: mean {self.mean_lag * 1000:.1f} ms, "
+                f"max {self.max_lag * 1000:.1f} ms")
@@ -0,0 +1,40 @@
+"""
+This Python file provides the semaphore that caps concurrent work in whichever event loop is running.
+An asyncio.Semaphore belongs to the loop it is first used in, and scripts may run several loops one after another,
+so one semaphore is created for each event loop and dropped together with its loop.
+"""
+import asyncio
+import weakref
+
+
+class LoopSemaphore:
+    """
+    Use this LoopSemaphore to:
+        1. cap the number of coroutines inside `async with` in the running event loop
+        2. get a fresh semaphore with the same cap in every new event loop
+    """
+
+    def __init__(self, value: int):
+        """
+        :param value: the number of coroutines inside at the same time
+        """
+        self.value = value
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def get(self) -> asyncio.Semaphore:
+        """
+        To Get the semaphore of the running event loop
+        :return: semaphore of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.value)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def __aenter__(self):
+        await self.get().acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.get().release()
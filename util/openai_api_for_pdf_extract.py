@@ -4,9 +4,11 @@ from PDF-converted images based on your input.
 """
 import json
 
-from openai import AsyncOpenAI
 import base64
 
+from util.openai_clients import create_async_openai
+from util.rate_limiter import estimate_tokens, arun_with_rate_limit
+
 
 # Function to encode the image
 def encode_image(image_path):
@@ -34,7 +36,7 @@ async def aget_openai_response(messages, section_id: str, section_name: str,
     :return: Extraced info of section
     """
     # Set the client for connection
-    client = AsyncOpenAI()
+    client = create_async_openai()
     # Set the output format
     response_format = {"type": "json_object"} if json_format else {"type": "text"}
     # Initialise the variables
@@ -43,12 +45,14 @@ async def aget_openai_response(messages, section_id: str, section_name: str,
     # Start to call Model API
     while try_count <= retry_num:
         try:
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                response_format=response_format
-            )
+            response = await arun_with_rate_limit(
+                lambda: client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    response_format=response_format
+                ),
+                tokens=estimate_tokens(messages))
             output = json.loads(response.choices[0].message.content)
         except Exception as e:
             try_count += 1
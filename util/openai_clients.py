@@ -0,0 +1,114 @@
+"""
+This Python file provides the factory of every OpenAI client of the project: chat models, embeddings models
+and raw OpenAI clients. They all share keep-alive HTTP connection pools with a finite timeout for each request.
+Every request goes through the global rate limiter in util/rate_limiter.py, so the clients are built without the
+retries of the OpenAI SDK, because the rate limiter retries 429 responses and transient errors itself,
+and retrying in both places would multiply the attempts.
+"""
+import threading
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from openai import AsyncOpenAI
+
+from globalParameter.parameters import MAX_CONNECTIONS, MAX_KEEPALIVE_CONNECTIONS, KEEPALIVE_EXPIRY, \
+    HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT
+from util.rate_limiter import estimate_tokens, run_with_rate_limit, arun_with_rate_limit
+
+# Process-wide HTTP connection pools shared by all clients
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+
+def get_http_clients() -> tuple[httpx.Client, httpx.AsyncClient]:
+    """
+    To Get the shared sync and async HTTP clients, created on first use
+    :return: sync HTTP client and async HTTP client
+    """
+    with _http_clients_lock:
+        if not _http_clients:
+            limits = httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                  max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                  keepalive_expiry=KEEPALIVE_EXPIRY)
+            timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+            _http_clients['sync'] = httpx.Client(limits=limits, timeout=timeout)
+            _http_clients['async'] = httpx.AsyncClient(limits=limits, timeout=timeout)
+        return _http_clients['sync'], _http_clients['async']
+
+
+def reset_http_clients():
+    """
+    To close the shared connection pools, the next client gets new ones.
+    Call it before reusing the clients inside a new event loop, because async connections belong to their loop.
+    """
+    with _http_clients_lock:
+        if _http_clients:
+            _http_clients.pop('sync').close()
+            # The async client can not be awaited here, drop it and let its loop clean up the connections
+            _http_clients.pop('async')
+
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """
+    A chat model which sends every completion through the global rate limiter, for callers which invoke the model
+    themselves, e.g. agents
+    """
+    # Without stream methods, stream() and astream() fall back to invoke(), so streamed calls are rate limited too
+    _stream = BaseChatModel._stream
+    _astream = BaseChatModel._astream
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return run_with_rate_limit(
+            lambda: super(RateLimitedChatOpenAI, self)._generate(messages, stop=stop, run_manager=run_manager,
+                                                                 **kwargs),
+            tokens=estimate_tokens(messages))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await arun_with_rate_limit(
+            lambda: super(RateLimitedChatOpenAI, self)._agenerate(messages, stop=stop, run_manager=run_manager,
+                                                                  **kwargs),
+            tokens=estimate_tokens(messages))
+
+
+def create_chat_openai(model: str, temperature: float) -> ChatOpenAI:
+    """
+    To create a chat model on top of the shared connection pools, its calls go through the rate limiter
+    :param model: The name of model you want to use
+    :param temperature: Higher scores indicate more random model outputs.
+    :return: chat model
+    """
+    http_client, http_async_client = get_http_clients()
+    return ChatOpenAI(model=model, temperature=temperature, max_retries=0,
+                      http_client=http_client, http_async_client=http_async_client)
+
+
+def create_rate_limited_chat_openai(model: str, temperature: float) -> RateLimitedChatOpenAI:
+    """
+    To create a chat model on top of the shared connection pools, which puts its calls through the rate limiter itself
+    :param model: The name of model you want to use
+    :param temperature: Higher scores indicate more random model outputs.
+    :return: rate limited chat model
+    """
+    http_client, http_async_client = get_http_clients()
+    return RateLimitedChatOpenAI(model=model, temperature=temperature, max_retries=0,
+                                 http_client=http_client, http_async_client=http_async_client)
+
+
+def create_openai_embeddings(**kwargs) -> OpenAIEmbeddings:
+    """
+    To create an OpenAI embeddings model on top of the shared connection pools, its calls go through the rate limiter
+    :param kwargs: other settings of OpenAIEmbeddings
+    :return: embeddings model
+    """
+    http_client, http_async_client = get_http_clients()
+    return OpenAIEmbeddings(max_retries=0, http_client=http_client, http_async_client=http_async_client, **kwargs)
+
+
+def create_async_openai() -> AsyncOpenAI:
+    """
+    To create a raw async OpenAI client on top of the shared connection pool, its calls go through the rate limiter
+    :return: async OpenAI client
+    """
+    http_client, http_async_client = get_http_clients()
+    return AsyncOpenAI(max_retries=0, http_client=http_async_client)
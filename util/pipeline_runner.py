@@ -0,0 +1,125 @@
+"""
+This Python file provides the runner shared by the main() of all generation versions and the evaluation.
+A bounded pool of workers pulls jobs from a queue, so a slow file only holds one worker
+instead of stalling a whole batch, and a new job starts as soon as any worker is free.
+Each job has its own timeout and retries, and the progress and throughput are reported while running.
+"""
+import asyncio
+import time
+
+from globalParameter.parameters import PIPELINE_WORKER_NUM, PIPELINE_JOB_TIMEOUT, PIPELINE_RETRY_NUM, \
+    PIPELINE_REPORT_INTERVAL
+from util.retry_policy import report_retry_counters
+
+
+class PipelineRunner:
+    """
+    Use this PipelineRunner to:
+        1. run async jobs with a bounded pool of workers pulling from a queue
+        2. time out and retry each job on its own
+        3. report the progress and throughput of the pipeline
+    """
+
+    def __init__(self, name: str, run_job, worker_num: int = PIPELINE_WORKER_NUM,
+                 timeout: float = PIPELINE_JOB_TIMEOUT, retry_num: int = PIPELINE_RETRY_NUM,
+                 report_interval: float = PIPELINE_REPORT_INTERVAL):
+        """
+        :param name: the name of pipeline shown in reports
+        :param run_job: async function(*job) running one job
+        :param worker_num: the number of jobs running at the same time
+        :param timeout: the seconds one try of a job can take, None for no timeout
+        :param retry_num: the number of retries of a job before it is given up
+        :param report_interval: the seconds between two progress reports
+        """
+        self.name = name
+        self.run_job = run_job
+        self.worker_num = worker_num
+        self.timeout = timeout
+        self.retry_num = retry_num
+        self.report_interval = report_interval
+
+        self.total_num = 0
+        self.done_jobs = []
+        self.failed_jobs = {}
+        self.running_num = 0
+        self.start_time = None
+
+    async def run(self, jobs: list[tuple]) -> dict:
+        """
+        To run all jobs and wait until every job is done or given up
+        :param jobs: the arguments of each job, e.g. [(file_name, generation_version), ...]
+        :return: {'done': [job, ...], 'failed': {job: error}}
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        self.total_num = len(jobs)
+        self.start_time = time.perf_counter()
+
+        workers = [asyncio.create_task(self._worker(queue=queue)) for _ in range(min(self.worker_num, len(jobs)))]
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+
+        print(f"[{self.name}] finished: {self.report()}")
+        print(f"[{self.name}] errors by class: {report_retry_counters()}")
+        for job, error in self.failed_jobs.items():
+            print(f"[{self.name}] FAILED {job}: {error}")
+        return {'done': self.done_jobs, 'failed': self.failed_jobs}
+
+    async def _worker(self, queue: asyncio.Queue):
+        while not queue.empty():
+            job = queue.get_nowait()
+            self.running_num += 1
+            try:
+                await self._run_with_retry(job=job)
+            finally:
+                self.running_num -= 1
+            status = 'given up' if job in self.failed_jobs else 'done'
+            print(f"[{self.name}] {job} {status}, {self.report()}")
+
+    async def _run_with_retry(self, job: tuple):
+        for try_count in range(self.retry_num + 1):
+            try:
+                await asyncio.wait_for(self.run_job(*job), timeout=self.timeout)
+                self.done_jobs.append(job)
+                return
+            except Exception as e:
+                error = repr(e) if not isinstance(e, asyncio.TimeoutError) else f"timeout after {self.timeout} s"
+                print(f"[{self.name}] {job} failed on try {try_count + 1}/{self.retry_num + 1}: {error}")
+        self.failed_jobs[job] = error
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print(f"[{self.name}] progress: {self.report()}")
+
+    def report(self) -> str:
+        """
+        To Get the progress and throughput of pipeline
+        :return: one line report
+        """
+        finished_num = len(self.done_jobs) + len(self.failed_jobs)
+        elapsed = time.perf_counter() - self.start_time
+        throughput = finished_num / elapsed * 60 if elapsed > 0 else 0.0
+        report = (f"{finished_num}/{self.total_num} jobs finished ({len(self.failed_jobs)} failed), "
+                  f"{self.running_num} running, {throughput:.2f} jobs/min, {elapsed:.0f} s elapsed")
+        if 0 < finished_num < self.total_num:
+            report += f", about {(self.total_num - finished_num) / finished_num * elapsed:.0f} s left"
+        return report
+
+
+async def run_pipeline(name: str, jobs: list[tuple], run_job, **kwargs) -> dict:
+    """
+    To run all jobs with a PipelineRunner
+    :param name: the name of pipeline shown in reports
+    :param jobs: the arguments of each job
+    :param run_job: async function(*job) running one job
+    :param kwargs: the settings of PipelineRunner, e.g. worker_num or timeout
+    :return: {'done': [job, ...], 'failed': {job: error}}
+    """
+    return await PipelineRunner(name=name, run_job=run_job, **kwargs).run(jobs=jobs)
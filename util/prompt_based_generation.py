@@ -1,41 +1,116 @@
-from langchain_openai import ChatOpenAI
+"""
+This Python file provides the model API call methods used by every generation, tool and evaluation script.
+All calls share one process-wide registry of chat models, keyed by (model, temperature, json_format),
+and the chat models share keep-alive HTTP connection pools instead of opening a new pool per call.
+Every call goes through the global rate limiter in util/rate_limiter.py,
+and completions are served from the on-disk cache in util/completion_cache.py when possible.
+"""
+import threading
+
 from globalParameter import parameters
 from globalParameter.parameters import MODEL
+from util.completion_cache import completion_cache, refresh_completions
+from util.openai_clients import create_chat_openai, reset_http_clients
+from util.rate_limiter import estimate_tokens, run_with_rate_limit, arun_with_rate_limit
+
+# Process-wide registry of chat models
+_chat_models = {}
+_registry_lock = threading.Lock()
+
+
+def get_chat_model(temperature: float, json_format: bool = False, model: str = MODEL):
+    """
+    To Get the shared chat model for the given settings, it is created only once per process
+    :param model: The name of model you want to use
+    :param temperature: Higher scores indicate more random model outputs.
+    :param json_format: True if you want the response to be Json format
+    :return: chat model (Runnable) that can be invoked with your prompt
+    """
+    key = (model, float(temperature), bool(json_format))
+    chat = _chat_models.get(key)
+    if chat is not None:
+        return chat
 
+    with _registry_lock:
+        # Another thread may have built it while we were waiting
+        if key not in _chat_models:
+            # Set up the GPT connection on top of the shared connection pools
+            chat = create_chat_openai(model=model, temperature=temperature)
+            if json_format:
+                chat = chat.with_structured_output(method="json_mode")
+            _chat_models[key] = chat
+    return _chat_models[key]
 
-def prompt_based_generation(prompt, temperature: float, json_format: bool = False, model: str = MODEL):
+
+def reset_chat_models():
+    """
+    To close the shared connection pools and empty the registry.
+    Call it before reusing this module inside a new event loop, because async connections belong to their loop.
+    """
+    with _registry_lock:
+        _chat_models.clear()
+        reset_http_clients()
+
+
+def prompt_based_generation(prompt, temperature: float, json_format: bool = False, model: str = MODEL,
+                            use_cache: bool = True):
     """
     Call model to answer your question
     :param prompt: Your complete prompt
     :param model: The name of model you want to use
     :param temperature: Higher scores indicate more random model outputs.
     :param json_format: True if you want the response to be Json format
+    :param use_cache: False if you want a fresh response even when the same call has been cached
     :return: model output based on your prompt and variables
     """
-    # Set up the GPT connecction
-    chat = ChatOpenAI(model=model, temperature=temperature)
-    if json_format:
-        chat = chat.with_structured_output(method="json_mode")
+    # Check if the same call has been answered before
+    cache_key = None
+    if use_cache and completion_cache.is_enabled_for(temperature):
+        cache_key = completion_cache.make_key(prompt=prompt, model=model, temperature=temperature,
+                                              json_format=json_format)
+        cached_response = None if refresh_completions.get() else completion_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+    # Get the shared GPT connection
+    chat = get_chat_model(model=model, temperature=temperature, json_format=json_format)
     # Call the model to response your prompt
-    response = chat.invoke(prompt)
+    response = run_with_rate_limit(lambda: chat.invoke(prompt), tokens=estimate_tokens(prompt))
+
+    # Store the response for the next time
+    if cache_key is not None:
+        completion_cache.put(cache_key, response)
 
     return response
 
 
-async def aprompt_based_generation(prompt, temperature: float, json_format: bool = False, model: str = MODEL):
+async def aprompt_based_generation(prompt, temperature: float, json_format: bool = False, model: str = MODEL,
+                                  use_cache: bool = True):
     """
     Call model to answer your question in Async way
     :param prompt: Your complete prompt
     :param model: The name of model you want to use
     :param temperature: Higher scores indicate more random model outputs.
     :param json_format: True if you want the response to be Json format
+    :param use_cache: False if you want a fresh response even when the same call has been cached
     :return: model output based on your prompt and variables
     """
-    # Set up the GPT connecction
-    chat = ChatOpenAI(model=model, temperature=temperature)
-    if json_format:
-        chat = chat.with_structured_output(method="json_mode")
+    # Check if the same call has been answered before
+    cache_key = None
+    if use_cache and completion_cache.is_enabled_for(temperature):
+        cache_key = completion_cache.make_key(prompt=prompt, model=model, temperature=temperature,
+                                              json_format=json_format)
+        cached_response = None if refresh_completions.get() else completion_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+    # Get the shared GPT connection
+    chat = get_chat_model(model=model, temperature=temperature, json_format=json_format)
     # Call the model to response your prompt in Async way
-    response = await chat.ainvoke(prompt)
+    response = await arun_with_rate_limit(lambda: chat.ainvoke(prompt), tokens=estimate_tokens(prompt))
+
+    # Store the response for the next time
+    if cache_key is not None:
+        completion_cache.put(cache_key, response)
 
     return response
@@ -0,0 +1,237 @@
+"""
+This Python file provides the global scheduler that every OpenAI request goes through.
+It is a token bucket aware of both requests per minute and tokens per minute, with a cap on concurrent requests,
+and it backs off adaptively (halving its rate) whenever the API answers with 429 Too Many Requests.
+Connection errors, timeouts and 5xx responses are retried with jittered backoff, the OpenAI clients do not retry.
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import openai
+
+from globalParameter.parameters import REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, MAX_CONCURRENT_REQUESTS, \
+    RATE_LIMIT_RETRY_NUM, TRANSIENT_ERROR_RETRY_NUM, COMPLETION_TOKENS_ESTIMATE
+from util.loop_semaphore import LoopSemaphore
+
+# Rough cost of one image input, used when estimating tokens of multimodal messages
+IMAGE_TOKENS_ESTIMATE = 765
+
+
+def estimate_tokens(prompt, completion_tokens: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    """
+    To estimate the tokens a request will use (about 4 characters per token), without loading a tokenizer
+    :param prompt: a string, a list of langchain messages or a list of OpenAI message dicts
+    :param completion_tokens: the number of tokens you expect the model to output
+    :return: estimated number of tokens
+    """
+    def count_content(content) -> int:
+        if isinstance(content, str):
+            return math.ceil(len(content) / 4)
+        if isinstance(content, dict):
+            if content.get('type') == 'image_url':
+                return IMAGE_TOKENS_ESTIMATE
+            return count_content(content.get('text') or content.get('content') or '')
+        if isinstance(content, (list, tuple)):
+            return sum(count_content(part) for part in content)
+        return count_content(getattr(content, 'content', str(content)))
+
+    return count_content(prompt) + completion_tokens
+
+
+class TokenBucketRateLimiter:
+    """
+    Use this TokenBucketRateLimiter to:
+        1. wait until both the request bucket and the token bucket can afford a request
+        2. cap the number of requests in flight, for sync and async callers alike
+        3. slow down after a 429 response and speed up again step by step after successes
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int,
+                 burst_seconds: float = 10, min_rate_scale: float = 0.1):
+        """
+        :param requests_per_minute: your RPM quota
+        :param tokens_per_minute: your TPM quota
+        :param max_concurrency: the maximum number of requests in flight
+        :param burst_seconds: how many seconds of quota can be spent in one burst
+        :param min_rate_scale: the lowest fraction of the quota the adaptive back off can fall to
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.burst_seconds = burst_seconds
+        self.min_rate_scale = min_rate_scale
+
+        self._lock = threading.Lock()
+        self._rate_scale = 1.0
+        self._request_level = self._capacity(requests_per_minute)
+        self._token_level = self._capacity(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._thread_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._loop_semaphore = LoopSemaphore(max_concurrency)
+
+    def _capacity(self, per_minute: int) -> float:
+        return per_minute * self._rate_scale * self.burst_seconds / 60
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_level = min(self._capacity(self.requests_per_minute),
+                                  self._request_level + elapsed * self.requests_per_minute * self._rate_scale / 60)
+        self._token_level = min(self._capacity(self.tokens_per_minute),
+                                self._token_level + elapsed * self.tokens_per_minute * self._rate_scale / 60)
+
+    def _reserve(self, tokens: int, requests: int = 1) -> float:
+        """
+        To take the request and tokens from the buckets, going into debt if needed
+        :return: the seconds you need to wait before the debt is paid back
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A single request bigger than the bucket can still run once the bucket is full
+            tokens = min(tokens, self._capacity(self.tokens_per_minute))
+            self._request_level -= requests
+            self._token_level -= tokens
+            request_rate = self.requests_per_minute * self._rate_scale / 60
+            token_rate = self.tokens_per_minute * self._rate_scale / 60
+            return max(0.0,
+                       -self._request_level / request_rate,
+                       -self._token_level / token_rate,
+                       self._blocked_until - now)
+
+    def on_rate_limited(self, retry_after: float = None):
+        """
+        To back off after a 429 response: halve the rate, empty the buckets and pause all callers
+        :param retry_after: the seconds suggested by the API, if any
+        """
+        with self._lock:
+            self._rate_scale = max(self.min_rate_scale, self._rate_scale / 2)
+            self._request_level = min(self._request_level, 0.0)
+            self._token_level = min(self._token_level, 0.0)
+            pause = retry_after if retry_after else self.burst_seconds * (1 - self._rate_scale)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+        print(f"Rate limited, slowing down to {self._rate_scale:.0%} of the quota for at least {pause:.1f}s")
+
+    def on_success(self):
+        """To recover the rate step by step after a successful request"""
+        if self._rate_scale < 1.0:
+            with self._lock:
+                self._rate_scale = min(1.0, self._rate_scale + 0.05)
+
+    def _record_result(self, error: BaseException = None):
+        if error is None:
+            self.on_success()
+        elif isinstance(error, openai.RateLimitError):
+            retry_after = None
+            try:
+                retry_after = float(error.response.headers.get('retry-after'))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            self.on_rate_limited(retry_after=retry_after)
+
+    @asynccontextmanager
+    async def alimit(self, tokens: int, requests: int = 1):
+        """
+        Async context manager that waits for quota and a free slot before the request runs inside it
+        :param tokens: the estimated tokens of the request
+        :param requests: the number of API requests made inside the context
+        """
+        async with self._loop_semaphore:
+            await asyncio.sleep(self._reserve(tokens=tokens, requests=requests))
+            try:
+                yield
+            except BaseException as e:
+                self._record_result(error=e)
+                raise
+            self._record_result()
+
+    @contextmanager
+    def limit(self, tokens: int, requests: int = 1):
+        """
+        Sync context manager that waits for quota and a free slot before the request runs inside it
+        :param tokens: the estimated tokens of the request
+        :param requests: the number of API requests made inside the context
+        """
+        with self._thread_semaphore:
+            time.sleep(self._reserve(tokens=tokens, requests=requests))
+            try:
+                yield
+            except BaseException as e:
+                self._record_result(error=e)
+                raise
+            self._record_result()
+
+
+# The one scheduler shared by all OpenAI traffic of this process
+rate_limiter = TokenBucketRateLimiter(requests_per_minute=REQUESTS_PER_MINUTE,
+                                      tokens_per_minute=TOKENS_PER_MINUTE,
+                                      max_concurrency=MAX_CONCURRENT_REQUESTS)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    # Connection errors (including timeouts) and 5xx responses usually pass when the request is sent again
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+
+def get_transient_error_delay(try_count: int) -> float:
+    """
+    To Get the backoff after a transient error, with full jitter so concurrent requests do not retry together
+    :param try_count: the number of transient errors so far, starting from 1
+    :return: seconds to wait
+    """
+    return random.uniform(0, min(60, 2 ** (try_count - 1)))
+
+
+async def arun_with_rate_limit(request_func, tokens: int, requests: int = 1):
+    """
+    To run an async OpenAI request under the global scheduler, retrying it when it is rate limited
+    or fails with a transient error
+    :param request_func: a function without arguments which returns the awaitable request
+    :param tokens: the estimated tokens of the request
+    :param requests: the number of API requests made by request_func
+    :return: the result of the request
+    """
+    rate_limit_count, transient_error_count = 0, 0
+    while True:
+        try:
+            async with rate_limiter.alimit(tokens=tokens, requests=requests):
+                return await request_func()
+        except openai.RateLimitError:
+            rate_limit_count += 1
+            if rate_limit_count > RATE_LIMIT_RETRY_NUM:
+                raise
+        except Exception as e:
+            transient_error_count += 1
+            if not is_transient_error(e) or transient_error_count > TRANSIENT_ERROR_RETRY_NUM:
+                raise
+            await asyncio.sleep(get_transient_error_delay(try_count=transient_error_count))
+
+
+def run_with_rate_limit(request_func, tokens: int, requests: int = 1):
+    """
+    To run a sync OpenAI request under the global scheduler, retrying it when it is rate limited
+    or fails with a transient error
+    :param request_func: a function without arguments which makes the request
+    :param tokens: the estimated tokens of the request
+    :param requests: the number of API requests made by request_func
+    :return: the result of the request
+    """
+    rate_limit_count, transient_error_count = 0, 0
+    while True:
+        try:
+            with rate_limiter.limit(tokens=tokens, requests=requests):
+                return request_func()
+        except openai.RateLimitError:
+            rate_limit_count += 1
+            if rate_limit_count > RATE_LIMIT_RETRY_NUM:
+                raise
+        except Exception as e:
+            transient_error_count += 1
+            if not is_transient_error(e) or transient_error_count > TRANSIENT_ERROR_RETRY_NUM:
+                raise
+            time.sleep(get_transient_error_delay(try_count=transient_error_count))
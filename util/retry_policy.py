@@ -0,0 +1,114 @@
+"""
+This Python file provides the retry policy shared by all generation, refinement and evaluation calls.
+Each error is classified as rate_limit, timeout, bad_json or fatal. Retryable errors are retried
+with jittered exponential backoff up to a maximum number of attempts, and fatal errors are raised at once,
+so one bad section neither retries forever nor blocks the event loop.
+The errors of every class are counted per policy, see report_retry_counters().
+"""
+import asyncio
+import json
+import random
+from collections import Counter
+
+import httpx
+import openai
+from langchain_core.exceptions import OutputParserException
+
+from globalParameter.parameters import RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from util.completion_cache import refresh_completions
+
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+BAD_JSON = "bad_json"
+FATAL = "fatal"
+
+# The errors of every class seen by every policy of this process, keyed by (policy name, error class)
+retry_counters = Counter()
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    To classify an error raised by a call
+    :param error: the error
+    :return: rate_limit, timeout, bad_json or fatal
+    """
+    if isinstance(error, openai.RateLimitError):
+        return RATE_LIMIT
+    if isinstance(error, (TimeoutError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+                          httpx.TimeoutException, httpx.NetworkError)):
+        return TIMEOUT
+    # The model answered, but not with the Json (or the keys) that was asked for
+    if isinstance(error, (OutputParserException, json.JSONDecodeError, KeyError, ValueError)):
+        return BAD_JSON
+    return FATAL
+
+
+class RetryPolicy:
+    """
+    Use this RetryPolicy to:
+        1. run an async call with an optional timeout for each attempt
+        2. retry rate_limit, timeout and bad_json errors with jittered exponential backoff
+        3. count the errors of every class
+    Note:
+        Attempts after a bad_json error skip the completion cache, so they get a fresh response
+    """
+
+    def __init__(self, name: str, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, timeout: float = None,
+                 retry_classes: tuple = (RATE_LIMIT, TIMEOUT, BAD_JSON)):
+        """
+        :param name: the name of policy shown in logs and counters
+        :param max_attempts: the number of attempts before the last error is raised
+        :param base_delay: the seconds of backoff after the first failed attempt, doubled after each attempt
+        :param max_delay: the maximum seconds of backoff
+        :param timeout: the seconds one attempt can take, None for no timeout
+        :param retry_classes: the error classes which are retried
+        """
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.retry_classes = retry_classes
+
+    def get_delay(self, attempt: int) -> float:
+        """
+        To Get the backoff after a failed attempt, with full jitter so concurrent calls do not retry together
+        :param attempt: the number of the failed attempt, starting from 1
+        :return: seconds to wait
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def arun(self, request_func, label: str = ""):
+        """
+        To run an async call under this policy
+        :param request_func: a function without arguments which returns the awaitable call
+        :param label: what the call is for, shown in logs
+        :return: the result of the call
+        """
+        refresh = False
+        for attempt in range(1, self.max_attempts + 1):
+            token = refresh_completions.set(refresh)
+            try:
+                return await asyncio.wait_for(request_func(), timeout=self.timeout)
+            except Exception as e:
+                error_class = classify_error(e)
+                retry_counters[(self.name, error_class)] += 1
+                print(f"[{self.name}] {label + ' ' if label else ''}{error_class} error "
+                      f"on attempt {attempt}/{self.max_attempts}: {e!r}")
+                if error_class not in self.retry_classes or attempt == self.max_attempts:
+                    raise
+                refresh = refresh or error_class == BAD_JSON
+            finally:
+                refresh_completions.reset(token)
+            await asyncio.sleep(self.get_delay(attempt=attempt))
+
+
+def report_retry_counters() -> str:
+    """
+    To Get the errors of every class seen by every policy
+    :return: one line report
+    """
+    if not retry_counters:
+        return "no errors"
+    return ", ".join(f"{name} {error_class}: {count}" for (name, error_class), count in sorted(retry_counters.items()))
@@ -0,0 +1,71 @@
+"""
+This Python file provides the scheduler that generates the sections of a file concurrently.
+Sections of a file do not depend on each other, so they run at the same time,
+under one cap on the number of sections in progress shared by all files.
+"""
+import asyncio
+
+from globalParameter.parameters import SECTION_CONCURRENCY
+from util.loop_semaphore import LoopSemaphore
+
+# One semaphore per event loop, shared by every file generated in that loop
+_section_semaphore = LoopSemaphore(SECTION_CONCURRENCY)
+
+
+def get_section_semaphore() -> asyncio.Semaphore:
+    """
+    To Get the semaphore which caps the number of sections in progress across all files
+    :return: semaphore of the running event loop
+    """
+    return _section_semaphore.get()
+
+
+def get_template_section_ids(doc_template: dict) -> list[str]:
+    """
+    To Get all section ids in template order
+    :param doc_template: the template structure
+    :return: section ids
+    """
+    section_ids = []
+    for chapter_id, chapter_template in doc_template.items():
+        section_ids.extend(chapter_template["sections"].keys())
+    return section_ids
+
+
+async def generate_sections_concurrently(doc_template: dict, done_section_ids: set[str], generate_section,
+                                         on_section_done=None) -> dict:
+    """
+    To generate all sections of a file concurrently, skipping the sections generated in the past
+    :param doc_template: the template structure
+    :param done_section_ids: the ids of sections generated in the past
+    :param generate_section: async function(chapter_id, section_id, section_template) returning the section generation
+    :param on_section_done: function(section_id, section_generation) called as soon as each section is done
+    :return: the sections generated in this call, in template order
+    """
+    section_ids = get_template_section_ids(doc_template=doc_template)
+
+    async def run_section(chapter_id: str, section_id: str, section_template: dict):
+        async with get_section_semaphore():
+            return section_id, await generate_section(chapter_id, section_id, section_template)
+
+    # Start all sections which have not been generated yet
+    tasks = []
+    for chapter_id, chapter_template in doc_template.items():
+        for section_id, section_template in chapter_template["sections"].items():
+            if section_id in done_section_ids:
+                continue
+            tasks.append(asyncio.create_task(run_section(chapter_id, section_id, section_template)))
+
+    file_generation = {}
+    try:
+        # Store each section as soon as it is done
+        for task in asyncio.as_completed(tasks):
+            section_id, section_generation = await task
+            file_generation[section_id] = section_generation
+            if on_section_done is not None:
+                on_section_done(section_id, section_generation)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return {section_id: file_generation[section_id] for section_id in section_ids if section_id in file_generation}
@@ -0,0 +1,115 @@
+"""
+This Python file provides the store of generated sections shared by all generation versions.
+Each section is committed to a SQLite file as soon as it is generated, so a crash loses at most the sections in progress,
+and resuming only needs an index lookup of the section ids.
+When a file is done, its sections are compacted into the JSON layout of generated_file/{DOMAIN}/version_N/<file>.json.
+"""
+import json
+import os
+import sqlite3
+
+from globalParameter.parameters import DOMAIN, SECTION_STORE_SYNC_EVERY
+
+
+class SectionStore:
+    """
+    Use this SectionStore to:
+        1. commit each generated section atomically, syncing to disk every few sections
+        2. check which sections of a file are done
+        3. compact all sections into the generated JSON file
+    """
+
+    def __init__(self, generation_version: str, file_name_without_extension: str,
+                 sync_every: int = SECTION_STORE_SYNC_EVERY):
+        """
+        :param generation_version: the version of generation, e.g. '4' or '3_5'
+        :param file_name_without_extension: the file you are generating
+        :param sync_every: the number of committed sections between two syncs to disk
+        """
+        self.generation_version = generation_version
+        self.file_name_without_extension = file_name_without_extension
+        self.json_path = f"generated_file/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.json"
+        self.store_path = f"section_store/{DOMAIN}/version_{generation_version}/{file_name_without_extension}.sqlite"
+        self.sync_every = sync_every
+        self._unsynced_num = 0
+
+        is_new_store = not os.path.isfile(self.store_path)
+        os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+        self._connection = sqlite3.connect(self.store_path)
+        # In WAL mode every commit is atomic, and the disk is only synced at checkpoints
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS sections (
+            section_id TEXT PRIMARY KEY, section_name TEXT NOT NULL, generation TEXT NOT NULL)""")
+        self._connection.commit()
+
+        # Take over the sections of a JSON file generated before the store existed
+        if is_new_store and os.path.isfile(self.json_path):
+            with open(self.json_path, 'r', encoding='utf-8') as f:
+                for section_id, section_generation in json.load(f).items():
+                    self.put(section_id=section_id, section_generation=section_generation)
+            self.sync()
+
+    def done_section_ids(self) -> set[str]:
+        """
+        To Get the ids of sections which have been generated
+        :return: set of section ids
+        """
+        return {row[0] for row in self._connection.execute("SELECT section_id FROM sections")}
+
+    def get(self, section_id: str):
+        """
+        To Get a generated section
+        :param section_id: the id of section
+        :return: {'section_name': ..., 'generation': ...}, or None if it has not been generated
+        """
+        row = self._connection.execute("SELECT section_name, generation FROM sections WHERE section_id = ?",
+                                       (section_id,)).fetchone()
+        if row is None:
+            return None
+        return {'section_name': row[0], 'generation': json.loads(row[1])}
+
+    def put(self, section_id: str, section_generation: dict):
+        """
+        To commit a generated section
+        :param section_id: the id of section
+        :param section_generation: {'section_name': ..., 'generation': ...}
+        """
+        self._connection.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?)",
+                                 (section_id, section_generation['section_name'],
+                                  json.dumps(section_generation['generation'], ensure_ascii=False)))
+        self._connection.commit()
+        self._unsynced_num += 1
+        if self._unsynced_num >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """To write all committed sections into the main database file and sync it to disk"""
+        self._connection.execute("PRAGMA wal_checkpoint(FULL)")
+        self._unsynced_num = 0
+
+    def compact(self, section_ids: list[str]) -> dict:
+        """
+        To write all generated sections into the JSON file, replacing it atomically
+        :param section_ids: all section ids in template order
+        :return: the generation of whole file
+        """
+        file_generation = {}
+        for section_id in section_ids:
+            section_generation = self.get(section_id=section_id)
+            if section_generation is not None:
+                file_generation[section_id] = section_generation
+
+        os.makedirs(os.path.dirname(self.json_path), exist_ok=True)
+        temp_path = self.json_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(file_generation, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.json_path)
+
+        return file_generation
+
+    def close(self):
+        self.sync()
+        self._connection.close()
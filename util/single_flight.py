@@ -0,0 +1,44 @@
+"""
+This Python file provides the single-flight helper shared by the caches of the project.
+Callers asking for a key which is still being computed wait for that computation instead of starting another one.
+The computation runs in its own task, so a caller which is cancelled or times out only stops waiting,
+and the other callers of the same key still get the result.
+"""
+import asyncio
+import functools
+
+
+class SingleFlight:
+    """
+    Use this SingleFlight to:
+        1. run one computation per key at a time
+        2. share its result, or its error, with every concurrent caller of the same key
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def is_pending(self, key) -> bool:
+        return key in self._pending
+
+    def _on_done(self, key, task: asyncio.Task):
+        if self._pending.get(key) is task:
+            del self._pending[key]
+        # Nobody may be waiting for this task any more
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, compute):
+        """
+        To Get the result of compute for a key, joining the computation in progress of the same key if any
+        :param key: a hashable key of the computation
+        :param compute: a function without arguments which returns the awaitable result
+        :return: the result of compute
+        """
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._pending[key] = task
+            task.add_done_callback(functools.partial(self._on_done, key))
+        # Do not let a cancelled caller, even the one which started the computation, cancel it for the others
+        return await asyncio.shield(task)
@@ -0,0 +1,98 @@
+"""
+This Python file provides the persistent store of section summaries used by the METEOR of summary.
+The summary of a target section is stored under (file, section, summary model), so it is written once
+and shared by every generation version evaluated against it, and the summary of a generated section
+is stored under the hash of its text, so only new generated text costs an API call.
+Callers asking for a summary which is still being written wait for it instead of asking again.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+from globalParameter.parameters import SUMMARY_STORE_PATH
+from util.prompt_based_generation import aprompt_based_generation
+from util.single_flight import SingleFlight
+
+
+class SummaryStore:
+    """
+    Use this SummaryStore to:
+        1. keep the summary of each target section by (file, section, summary model)
+        2. keep the summary of each generated text by (text hash, summary model)
+        3. summarize a text only if its summary is not stored, sharing one call between concurrent callers
+    """
+
+    def __init__(self, path: str = SUMMARY_STORE_PATH):
+        """
+        :param path: the SQLite file of store
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._single_flight = SingleFlight()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the store only when it is used for the first time
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY, text_hash TEXT NOT NULL, summary TEXT NOT NULL)""")
+        return self._connection
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def reference_key(file_name_without_extension: str, section_id: str, model: str) -> str:
+        return f"reference\0{file_name_without_extension}\0{section_id}\0{model}"
+
+    @staticmethod
+    def generation_key(text: str, model: str) -> str:
+        return f"generation\0{SummaryStore.hash_text(text)}\0{model}"
+
+    def get(self, key: str, text: str):
+        """
+        To Get a stored summary
+        :param key: the key of summary
+        :param text: the text which was summarized, a summary of a different text is not returned
+        :return: the summary, or None if it is not stored
+        """
+        with self._lock:
+            row = self._connect().execute("SELECT text_hash, summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] != self.hash_text(text):
+            return None
+        return row[1]
+
+    def put(self, key: str, text: str, summary: str):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", (key, self.hash_text(text), summary))
+            connection.commit()
+
+    async def asummarize(self, key: str, text: str, model: str) -> str:
+        """
+        To Get the summary of a text, calling the model only if it is not stored
+        :param key: the key of summary, see reference_key() and generation_key()
+        :param text: the text to summarize
+        :param model: The name of model
+        :return: the summary
+        """
+        summary = self.get(key=key, text=text)
+        if summary is not None:
+            return summary
+
+        async def summarize():
+            response = await aprompt_based_generation(prompt=f"please summarize the following section context:\n{text}",
+                                                      model=model, temperature=0)
+            self.put(key=key, text=text, summary=response.content)
+            return response.content
+
+        return await self._single_flight.run(key, summarize)
+
+
+# The one store of summaries shared by all evaluations of this process
+summary_store = SummaryStore()
@@ -0,0 +1,121 @@
+"""
+This Python file provides the in-memory cache of tool results for each document.
+Sections of the same document often ask the same question (project proponent, location, start date ...),
+so an answer is stored under its knowledge base and normalized question and reused by later sections,
+and callers asking a question which is still being answered wait for that answer instead of asking again.
+Optionally, a question whose embedding is close enough to a stored question reuses its answer too.
+The results of a knowledge base are cleared when its document is done.
+"""
+import re
+from collections import Counter
+
+import numpy as np
+
+from globalParameter.parameters import TOOL_RESULT_CACHE_SIMILARITY
+from util.embeddings import get_openai_embeddings
+from util.single_flight import SingleFlight
+
+
+class ToolResultCache:
+    """
+    Use this ToolResultCache to:
+        1. reuse the result of a question which has been asked in the same knowledge base
+        2. share one call between concurrent callers of the same question
+        3. (optional) reuse the result of a near-duplicate question, by the cosine similarity of question embeddings
+    """
+
+    def __init__(self, similarity_threshold: float = TOOL_RESULT_CACHE_SIMILARITY):
+        """
+        :param similarity_threshold: the cosine similarity above which two questions share a result,
+                                     None to reuse the results of identical questions only
+        """
+        self.similarity_threshold = similarity_threshold
+        self._results = {}
+        self._single_flight = SingleFlight()
+        self._question_embeddings = {}
+        self.counters = Counter()
+        self._embeddings_model = None
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        # Ignore case, repeated spaces and punctuation around the question
+        return re.sub(r"\s+", " ", question).strip().strip("?.!,;: ").lower()
+
+    def _get_embeddings_model(self):
+        # Build the embeddings model only when near-duplicate lookup is used
+        if self._embeddings_model is None:
+            self._embeddings_model = get_openai_embeddings()
+        return self._embeddings_model
+
+    async def _find_similar(self, knowledge_base: str, question: str):
+        """To Get the key of the stored question most similar to question, or None if none is similar enough"""
+        keys, embeddings = self._question_embeddings.get(knowledge_base, ([], []))
+        if not keys:
+            return None
+        question_embedding = np.asarray(await self._get_embeddings_model().aembed_query(question), dtype=np.float32)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        similarities = matrix @ question_embedding / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(question_embedding))
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return keys[best]
+        return None
+
+    async def _store_embedding(self, knowledge_base: str, key: tuple, question: str):
+        embedding = await self._get_embeddings_model().aembed_query(question)
+        keys, embeddings = self._question_embeddings.setdefault(knowledge_base, ([], []))
+        keys.append(key)
+        embeddings.append(embedding)
+
+    async def aget_or_compute(self, question: str, knowledge_base: str, compute, extra_key: tuple = ()):
+        """
+        To Get the result of a question, calling compute only if the question has not been answered
+        :param question: the question asked to the tool
+        :param knowledge_base: the knowledge base of the document
+        :param compute: a function without arguments which returns the awaitable result
+        :param extra_key: other arguments which change the result, e.g. (k_num,)
+        :return: the result of the question
+        """
+        key = (knowledge_base, self.normalize_question(question)) + tuple(extra_key)
+
+        # Reuse the answer of the same question
+        if key in self._results:
+            self.counters['hit'] += 1
+            return self._results[key]
+        joined = self._single_flight.is_pending(key)
+
+        async def compute_once():
+            # Reuse the answer of a near-duplicate question
+            if self.similarity_threshold is not None:
+                similar_key = await self._find_similar(knowledge_base=knowledge_base, question=question)
+                if similar_key is not None and similar_key[2:] == key[2:]:
+                    self.counters['similar_hit'] += 1
+                    return self._results[similar_key]
+
+            self.counters['miss'] += 1
+            result = await compute()
+            self._results[key] = result
+            if self.similarity_threshold is not None:
+                await self._store_embedding(knowledge_base=knowledge_base, key=key, question=question)
+            return result
+
+        # A caller which times out only stops waiting, the shared call still answers the others
+        result = await self._single_flight.run(key, compute_once)
+        if joined:
+            self.counters['hit'] += 1
+        return result
+
+    def clear(self, knowledge_base: str):
+        """
+        To remove all results of a knowledge base
+        :param knowledge_base: the knowledge base of a finished document
+        """
+        self._results = {key: result for key, result in self._results.items() if key[0] != knowledge_base}
+        self._question_embeddings.pop(knowledge_base, None)
+
+    def report(self) -> str:
+        return (f"{self.counters['hit']} hits, {self.counters['similar_hit']} near-duplicate hits, "
+                f"{self.counters['miss']} misses")
+
+
+# The one cache of tool results shared by all tools of this process
+tool_result_cache = ToolResultCache()